@@ -3,6 +3,7 @@ from collections import defaultdict
 import learning.evaluateFile as evaluateFile
 import learning.loading as loading
 import learning.evaluation as evaluation
+import learning.ontology as ontology
 import shutil
 from utils import Stream
 import itertools
@@ -139,6 +140,8 @@ def combine(dataPath, inputs, outDir=None, cafaTargets="external", modes="AND,OR
     task.loadProteins(cafaTargets)
     task.loadSplit()
     limitTerms = set([x[0] for x in task.topTerms])
+    ic = task.getIC(outDir)
+    ontologyIndex = task.getOntology() if cafaTargets != "skip" else None
     
     predKeys = [x["name"] for x in inputs]
     for item in inputs:
@@ -178,10 +181,13 @@ def combine(dataPath, inputs, outDir=None, cafaTargets="external", modes="AND,OR
                 try:
                     results = evaluation.evaluate(examples["labels"], examples["predictions"], examples, terms=None, averageOnly=True, noAUC=True)
                     print "Average for", str(combination) + "/" + setName + "/" + mode + ":", evaluation.metricsToString(results["average"])
+                    print "CAFA for", str(combination) + "/" + setName + "/" + mode + ":", evaluation.cafaToString(evaluation.evaluateCAFA(examples["labels"], evaluateFile.makeConfidences(task.proteins, examples, combConfKey), ic.getArray(examples["label_names"]) if ic != None else None))
                 except TypeError as e:
                     print "WARNING! Cannot evaluate results."
                     print e
                 if useOutFiles:
+                    if setName == "cafa" and ontologyIndex != None:
+                        ontology.propagateProteins(task.proteins, combKey, ontologyIndex, limitTerms, limitToSets=[setName])
                     combString = "-".join(combination)
                     outPath = os.path.join(outDir, "-".join([combString, setName, mode, "ensemble"]) + ".tsv.gz")
                     evaluation.saveProteins(task.proteins, outPath, limitTerms=limitTerms, limitToSets=[setName], predKey=combKey) #pass#evaluation.saveResults(data, outStem, label_names, negatives)
@@ -1,5 +1,9 @@
-from evaluation import evaluate, metricsToString, getResultsString, resultIsBetter, saveResults
+from evaluation import evaluate, metricsToString, getResultsString, resultIsBetter, saveResults, toDense
 from sklearn.grid_search import ParameterGrid, GridSearchCV
+from sklearn.ensemble.forest import ForestClassifier
+from sklearn.tree import DecisionTreeClassifier
+from sklearn.tree.tree import BaseDecisionTree
+from sklearn.ensemble.base import BaseEnsemble
 import os
 # from sklearn.preprocessing.label import LabelBinarizer
 # from sklearn.externals.joblib.parallel import Parallel, delayed
@@ -8,6 +12,15 @@ import numpy as np
 import pickle
 from sklearn.externals import joblib
 import gzip
+import sys
+import shutil
+import tempfile
+import time
+import itertools
+import resource
+from multiprocessing import Pool, cpu_count
+from cStringIO import StringIO
+from loading import getSubsetIndices
 
 def importNamed(name):
     asName = name.rsplit(".", 1)[-1]
@@ -28,18 +41,137 @@ def importNamed(name):
         raise Exception("Could not import '" + name + "'")
     return eval(asName)
 
+def getPositiveProbabilities(classifier, probabilities):
+    """
+    Convert the output of predict_proba into a (n_samples, n_outputs) float32 matrix of the 
+    positive class probabilities. Multi-output classifiers return a list of (n_samples, n_classes) 
+    arrays, and an output with only one class in the training data has a single column.
+    """
+    classes = classifier.classes_
+    if not isinstance(probabilities, list): # Single output
+        probabilities, classes = [probabilities], [classes]
+    positive = np.zeros((probabilities[0].shape[0], len(probabilities)), dtype=np.float32)
+    for i in range(len(probabilities)):
+        column = np.flatnonzero(np.asarray(classes[i]) == 1)
+        if len(column) > 0:
+            positive[:, i] = probabilities[i][:, column[0]]
+    return positive
+
+def predictBatches(classifier, features, batchCells=2000000):
+    """
+    Predict the labels and the positive class probabilities of the features. Forests are walked
+    once per block of rows, the predictions are derived from the class probabilities like in their
+    predict method and the positive class probabilities are written into a preallocated float32 matrix.
+    Other classifiers use predict and predict_proba on the whole matrix.
+    """
+    if not isinstance(classifier, (ForestClassifier, DecisionTreeClassifier)):
+        predicted = classifier.predict(features)
+        probabilities = None
+        if hasattr(classifier, "predict_proba"):
+            print "Predicting probabilities"
+            probabilities = getPositiveProbabilities(classifier, classifier.predict_proba(features))
+        return predicted, probabilities
+    numRows = features.shape[0]
+    classes = classifier.classes_ if classifier.n_outputs_ > 1 else [classifier.classes_]
+    if classifier.n_outputs_ > 1:
+        predicted = np.zeros((numRows, len(classes)))
+    else:
+        predicted = np.zeros(numRows, dtype=classifier.classes_.dtype)
+    probabilities = np.zeros((numRows, len(classes)), dtype=np.float32)
+    batchSize = max(1, batchCells // len(classes))
+    print "Predicting probabilities for", numRows, "rows in batches of", batchSize
+    for start in range(0, numRows, batchSize):
+        startTime = time.time()
+        end = min(start + batchSize, numRows)
+        batch = classifier.predict_proba(features[start:end])
+        probabilities[start:end] = getPositiveProbabilities(classifier, batch)
+        if classifier.n_outputs_ == 1:
+            predicted[start:end] = classes[0].take(np.argmax(batch, axis=1), axis=0)
+        else:
+            for i in range(len(classes)):
+                predicted[start:end, i] = classes[i].take(np.argmax(batch[i], axis=1), axis=0)
+        print "Predicted rows", start, "-", end, "in", "%.2f" % (time.time() - startTime), "s"
+    return predicted, probabilities
+
+_gridWorker = {}
+
+def _initGridWorker(Classifier, dataPath, tempDir):
+    _gridWorker.update({"Classifier":Classifier, "data":joblib.load(dataPath, mmap_mode="c"), "tempDir":tempDir})
+
+def _learnGridPoint(params):
+    """
+    Fit and predict a single point of the parameter grid in a worker process. The train and devel 
+    matrices are shared as copy-on-write memory maps. The model is dumped into the temporary directory 
+    and its path is returned with the predictions, the feature importances and the output 
+    printed while learning.
+    """
+    index, args = params
+    data = _gridWorker["data"]
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        print "Learning with args", args
+        print "Initializing classifier", _gridWorker["Classifier"].__name__, "with arguments", args
+        cls = _gridWorker["Classifier"](**args)
+        print "Training, train / test = ", data["trainFeatures"].shape[0], "/", data["testFeatures"].shape[0]
+        cls.fit(data["trainFeatures"], data["trainLabels"])
+        print "Predicting"
+        predicted, probabilities = predictBatches(cls, data["testFeatures"])
+        importances = cls.feature_importances_ if hasattr(cls, "feature_importances_") else None
+        modelPath = os.path.join(_gridWorker["tempDir"], "model-" + str(index) + ".dump")
+        joblib.dump(cls, modelPath)
+        return predicted, probabilities, importances, modelPath, sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+
+_labelWorker = {}
+
+def _initLabelWorker(Classifier, classifierArgs, dataPath):
+    _labelWorker.update({"Classifier":Classifier, "classifierArgs":classifierArgs, "data":joblib.load(dataPath, mmap_mode="c")})
+
+def _learnLabel(labelIndex):
+    """
+    Search the parameter grid for a single label in a worker process, then train the classifier 
+    with the best parameters on the train set and predict the devel, test and CAFA sets. The feature 
+    and label matrices are shared as copy-on-write memory maps. Returns the best parameters and 
+    the predictions with the output printed while learning.
+    """
+    data = _labelWorker["data"]
+    Classifier = _labelWorker["Classifier"]
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        clf = GridSearchCV(Classifier(), _labelWorker["classifierArgs"], "f1", cv=data["cv"], refit=False)
+        clf.fit(data["gridFeatures"], data["gridLabels"][:, labelIndex])
+        print "Best params", (clf.best_params_, clf.best_score_)
+        print "Initializing classifier", Classifier.__name__, "with arguments", clf.best_params_
+        cls = Classifier(**clf.best_params_)
+        print "Training, train / devel = ", data["features"]["train"].shape[0], "/", data["features"]["devel"].shape[0]
+        cls.fit(data["features"]["train"], data["labels"]["train"][:, labelIndex])
+        predictions = {}
+        for setName in data["setNames"]:
+            predictions[setName], probabilities = predictBatches(cls, data["features"][setName])
+            if setName == "devel":
+                develProbabilities = probabilities
+        results = evaluate(data["labels"]["devel"][:, labelIndex], predictions["devel"], None, averageOnly=True, average="binary", probabilities=develProbabilities)
+        print "Average:", metricsToString(results["average"])
+        return labelIndex, clf.best_params_, predictions, sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+
 class Classification():
-    def __init__(self):
+    def __init__(self, gridJobs=None):
         self.Classifier = None
-        self.modelSaving = "joblib"
+        self.modelSaving = "auto" # Compressed joblib for tree models, uncompressed (memory-mapped when loaded) for the others
+        self.gridJobs = gridJobs # The number of processes for evaluating the parameter grid in parallel
+        self.ontology = None # An ontology index for propagating the CAFA set predictions to the ancestor terms
         
     def getSubset(self, examples, setNames):
-        sets = examples["sets"]
-        indices = [i for i in range(len(sets)) if any(x in setNames for x in sets[i])]
+        indices = getSubsetIndices(examples, setNames)
         features = examples["features"][indices]
         labels = examples["labels"][indices]
-        ids = [examples["ids"][i] for i in range(len(sets)) if any(x in setNames for x in sets[i])]
-        cafa_ids = [examples["cafa_ids"][i] for i in range(len(sets)) if any(x in setNames for x in sets[i])]
+        ids = examples["ids"][indices]
+        cafa_ids = examples["cafa_ids"][indices]
         return features, labels, indices, ids, cafa_ids
     
     def learn(self, args, examples, trainSets, testSets, terms, cls=None, averageOnly=False, average="micro"):
@@ -56,12 +188,8 @@ class Classification():
         print "Training, train / test = ", trainFeatures.shape[0], "/", testFeatures.shape[0]
         cls.fit(trainFeatures, trainLabels)
         print "Predicting"
-        predicted = cls.predict(testFeatures)
-        probabilities = None
-        if hasattr(cls, "predict_proba"):
-            print "Predicting probabilities"
-            probabilities = cls.predict_proba(testFeatures)
-        results = evaluate(testLabels, predicted, examples, terms, averageOnly=averageOnly, average=average)
+        predicted, probabilities = predictBatches(cls, testFeatures)
+        results = evaluate(testLabels, predicted, examples, terms, averageOnly=averageOnly, average=average, probabilities=probabilities)
         print "Average:", metricsToString(results["average"])
         if not averageOnly:
             print getResultsString(results, 20, ["average"])
@@ -72,61 +200,148 @@ class Classification():
             data["feature_importances"] = cls.feature_importances_        
         return cls, data
     
-#     def warmStartGrid(self, classifierArgs, examples, terms):
-#         print "Using warm start parameter grid search"
-#         for key in classifierArgs:
-#             if key != "n_estimators" and len(classifierArgs[key]) > 1:
-#                 raise Exception("Multiple classifier argument values defined for argument '" + str(key) + "'")
-#         args = classifierArgs.copy()
-#         numEstimatorList = sorted(args["n_estimators"])
-#         args["n_estimators"] = [numEstimatorList[0]]
-#         args = {x:args[x][0] for x in args.keys()}
-#         cls = None
-#         best = None
-#         performances = []
-#         for n in numEstimatorList:
-#             if cls != None:
-#                 args["n_estimators"] = n
-#                 cls.n_estimators = n
-#                 print "cls.n_estimators = ", cls.n_estimators
-#             cls, data = self.learn(args, examples, ["train"], ["devel"], False, terms, cls=cls, averageOnly=True)
-#             performances.append({x:data["results"]["average"][x] for x in ("auc", "fscore", "precision", "recall")})
-#             performances[-1]["n"] = n
-#             if best == None or resultIsBetter(best["results"], data["results"]):
-#                 best = data
-#             else: # Release the not-best results
-#                 data = None
-#         print "Warm start parameter grid search complete"
-#         for performance in performances:
-#             print performance["n"], "\t", metricsToString(performance)
-#         print "Full evaluation for the best results"
-#         best["results"] = evaluate(best["gold"], best["predicted"], examples, terms)
-#         return best
+    def warmStartGrid(self, classifierArgs, examples, terms, outDir):
+        """
+        Grow a single forest through the sorted n_estimators values, adding only the new trees 
+        at each step and evaluating the forest on the devel set.
+        """
+        print "Using warm start parameter grid search"
+        for key in classifierArgs:
+            if key != "n_estimators" and len(classifierArgs[key]) > 1:
+                raise Exception("Multiple classifier argument values defined for argument '" + str(key) + "'")
+        args = {x:classifierArgs[x][0] for x in classifierArgs.keys()}
+        numEstimatorList = sorted(classifierArgs["n_estimators"])
+        cls = None
+        best = None
+        performances = []
+        for n in numEstimatorList:
+            startTime = time.time()
+            args["n_estimators"] = n
+            if cls != None:
+                cls.n_estimators = n
+                print "cls.n_estimators = ", cls.n_estimators
+            cls, data = self.learn(args, examples, ["train"], ["devel"], terms, cls=cls, averageOnly=True)
+            performances.append({x:data["results"]["average"].get(x) for x in ("auc", "fscore", "precision", "recall")})
+            performances[-1]["n"] = n
+            performances[-1]["time"] = time.time() - startTime
+            print "Step n_estimators =", n, "took %.2f s" % performances[-1]["time"]
+            if best == None or resultIsBetter(best["results"], data["results"]):
+                best = data
+                self.saveModel(cls, outDir, "devel")
+            else: # Release the not-best results
+                data = None
+        print "Warm start parameter grid search complete"
+        for performance in performances:
+            print performance["n"], "\t", metricsToString(performance), "\t%.2f s" % performance["time"]
+        print "Full evaluation for the best results"
+        best["results"] = evaluate(best["gold"], best["predicted"], examples, terms, probabilities=best["probabilities"])
+        return best
+    
+    def parallelGrid(self, classifierArgs, examples, terms, outDir):
+        """
+        Evaluate the points of the parameter grid in a process pool. The train and devel subsets 
+        are dumped once into a temporary directory and memory mapped by the workers. The results 
+        are compared in grid order, so the best point is the same as with the serial search.
+        """
+        grid = list(ParameterGrid(classifierArgs))
+        print "Evaluating", len(grid), "parameter combinations using", self.gridJobs, "processes"
+        trainFeatures, trainLabels, _, _, _ = self.getSubset(examples, ["train"])
+        testFeatures, testLabels, _, testIds, testCafaIds = self.getSubset(examples, ["devel"])
+        tempDir = tempfile.mkdtemp(prefix="grid-")
+        pool = None
+        best = None
+        try:
+            dataPath = os.path.join(tempDir, "data.dump")
+            joblib.dump({"trainFeatures":trainFeatures, "trainLabels":trainLabels, "testFeatures":testFeatures}, dataPath)
+            trainFeatures = trainLabels = testFeatures = None
+            pool = Pool(min(self.gridJobs, len(grid)), _initGridWorker, (self.Classifier, dataPath, tempDir))
+            results = pool.imap(_learnGridPoint, list(enumerate(grid)), chunksize=1)
+            for args in grid:
+                predicted, probabilities, importances, modelPath, output = results.next()
+                sys.stdout.write(output)
+                data = {"results":evaluate(testLabels, predicted, examples, terms, probabilities=probabilities), "args":args.copy(), "predicted":predicted, "gold":testLabels, "ids":testIds, "cafa_ids":testCafaIds, "probabilities":probabilities}
+                if importances is not None:
+                    data["feature_importances"] = importances
+                print "Average:", metricsToString(data["results"]["average"])
+                print getResultsString(data["results"], 20, ["average"])
+                if best == None or resultIsBetter(best["results"], data["results"]):
+                    best = data
+                    self.saveModel(joblib.load(modelPath), outDir, "devel")
+                else: # Release the not-best results
+                    data = None
+                os.remove(modelPath)
+        finally:
+            if pool != None:
+                pool.terminate()
+            shutil.rmtree(tempDir)
+        return best
     
     def saveModel(self, clf, outDir, tag):
         if self.modelSaving != None:
-            assert self.modelSaving in ("pickle", "joblib")
-            if self.modelSaving == "pickle":
+            assert self.modelSaving in ("pickle", "joblib", "mmap", "auto")
+            modelSaving = self.modelSaving
+            if modelSaving == "auto":
+                # The trees copy their arrays when unpickled, so memory-mapping would only make the files larger
+                modelSaving = "joblib" if isinstance(clf, (BaseEnsemble, BaseDecisionTree)) else "mmap"
+            if modelSaving == "pickle":
                 modelPath = os.path.join(outDir, tag + "-model.pickle.gz")
                 with gzip.open(modelPath, "wb") as f:
                     print "Saving model", tag, "as", modelPath
                     pickle.dump(clf, f)
+            elif modelSaving == "mmap":
+                modelPath = os.path.join(outDir, tag + "-model.joblib")
+                print "Saving model", tag, "as", modelPath
+                joblib.dump(clf, modelPath)
             else:
                 modelPath = os.path.join(outDir, tag + "-model.dump")
                 print "Saving model", tag, "as", modelPath
                 joblib.dump(clf, modelPath, compress=9)
+            for suffix in ("-model.pickle.gz", "-model.joblib", "-model.dump"): # Remove models saved earlier in another format
+                otherPath = os.path.join(outDir, tag + suffix)
+                if otherPath != modelPath and os.path.exists(otherPath):
+                    os.remove(otherPath)
         else:
             print "Model '" + tag + "' not saved"
     
     def loadModel(self, inDir, tag):
-        modelPath = os.path.join(inDir, tag + "-model.pickle.gz")
-        with gzip.open(modelPath, "rb") as f:
+        """
+        Load the model saved with any of the saveModel formats. The arrays of an uncompressed 
+        joblib model are memory-mapped read-only, so they are not decompressed into memory 
+        and processes classifying with the same model share the file pages.
+        """
+        startTime = time.time()
+        modelPath = os.path.join(inDir, tag + "-model.joblib")
+        if os.path.exists(modelPath):
+            print "Loading memory-mapped model from", modelPath
+            model = joblib.load(modelPath, mmap_mode="r")
+        elif os.path.exists(os.path.join(inDir, tag + "-model.dump")):
+            modelPath = os.path.join(inDir, tag + "-model.dump")
             print "Loading model from", modelPath
-            return pickle.load(f)
+            model = joblib.load(modelPath)
+        else:
+            modelPath = os.path.join(inDir, tag + "-model.pickle.gz")
+            with gzip.open(modelPath, "rb") as f:
+                print "Loading model from", modelPath
+                model = pickle.load(f)
+        print "Model loaded in", "%.2f" % (time.time() - startTime), "s, peak memory", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, "MB"
+        return model
+    
+    def propagateSet(self, data, labelNames):
+        """
+        Make the predictions consistent with the ontology DAG by propagating them to the 
+        ancestor terms, before they are written as the CAFA target predictions.
+        """
+        if self.ontology != None:
+            print "Propagating the predictions to the ancestor terms"
+            data["predicted"] = self.ontology.propagateMax(data["predicted"], labelNames)
+            if data.get("probabilities") is not None:
+                data["probabilities"] = self.ontology.propagateMax(data["probabilities"], labelNames)
     
     def learnSet(self, args, examples, trainSets, testSets, terms, outDir, negatives, averageOnly=False, average="micro"):
         print "Learning sets", testSets, "using sets", trainSets
         clf, data = self.learn(args, examples, trainSets, testSets, terms, averageOnly=averageOnly, average=average)
+        if "cafa" in testSets:
+            self.propagateSet(data, examples["label_names"])
         if outDir != None:
             idStr = "_".join(sorted(testSets))
             saveResults(data, os.path.join(outDir, idStr), examples["label_names"], negatives=negatives, feature_names=examples["feature_names"])
@@ -144,18 +359,17 @@ class Classification():
                 idStr = "_".join(sorted(setNames))
                 classifier = self.loadModel(classifier, idStr)
             print "Predicting sets", setNames
-            data["predicted"] = classifier.predict(features)
-            if hasattr(classifier, "predict_proba"):
-                print "Predicting probabilities"
-                data["probabilities"] = classifier.predict_proba(features)
+            data["predicted"], data["probabilities"] = predictBatches(classifier, features)
             #print len(data["predicted"])
         else:
             print "Using existing predictions for sets", setNames, len(predictions)
             data["predicted"] = predictions
-        data["results"] = evaluate(data["gold"], data["predicted"], examples, terms, averageOnly=averageOnly, average=average)
+        data["results"] = evaluate(data["gold"], data["predicted"], examples, terms, averageOnly=averageOnly, average=average, probabilities=data.get("probabilities"))
         print "Average:", metricsToString(data["results"] ["average"])
         if not averageOnly:
             print getResultsString(data["results"] , 20, ["average"])
+        if "cafa" in setNames:
+            self.propagateSet(data, examples["label_names"])
         if outDir != None:
             idStr = "_".join(sorted(setNames))
             saveResults(data, os.path.join(outDir, idStr), examples["label_names"], negatives=negatives)
@@ -166,7 +380,9 @@ class Classification():
         print "Parameter grid search"
         self.Classifier = importNamed(classifier)
         if classifierArgs.get("warm_start") == [True]:
-            best = self.warmStartGrid(classifierArgs, examples, terms)
+            best = self.warmStartGrid(classifierArgs, examples, terms, outDir)
+        elif self.gridJobs > 1 and len(ParameterGrid(classifierArgs)) > 1:
+            best = self.parallelGrid(classifierArgs, examples, terms, outDir)
         else:
             for args in ParameterGrid(classifierArgs):
                 clf, data = self.learn(args, examples, ["train"], ["devel"], terms)
@@ -195,6 +411,7 @@ class Classification():
                 
 class SingleLabelClassification(Classification):
     def __init__(self, n_jobs):
+        Classification.__init__(self)
         self.n_jobs = n_jobs
     
 #     def catenateLabels(self, existing, labels):
@@ -204,54 +421,61 @@ class SingleLabelClassification(Classification):
 #             return np.array([existing, labels]) #np.concatenate((existing, labels))
     
     def optimize(self, classifier, classifierArgs, examples, terms=None, outDir=None, negatives=False, useTestSet=False, useCAFASet=False):
+        """
+        Search the parameters separately for each label in a process pool of n_jobs workers. The 
+        subsets and the train/devel split are built once and dumped into a temporary directory 
+        to be memory mapped by the workers. The results are collected in label order.
+        """
         print "Parameter grid search"
         self.Classifier = importNamed(classifier)
-        origLabels = examples["labels"]
-        origLabelNames = examples["label_names"]
+        labelNames = examples["label_names"]
         examples["label_args"] = {}
-        predictions = {"devel":[], "test":[], "cafa":[]}
-        print "Labels:", len(examples["label_names"])
-        for labelIndex in range(len(examples["label_names"])):
-            labelName = origLabelNames[labelIndex]
-            print "===", "Parameter search for label", labelIndex, terms[labelName], "==="
-            examples["labels"] = origLabels[:, labelIndex]
-            examples["label_names"] = [labelName]
-            gridFeatures, gridLabels, gridIds, _, _ = self.getSubset(examples, ["train", "devel"])
-            cv = [([], [])]
-            _, _, gridTrainIds, _, _ = self.getSubset(examples, ["train"])
-            gridTrainIds = set(gridTrainIds)
-            #_, _, gridDevelIds, _, _ = self.getSubset(examples, ["devel"])
-            #gridDevelIds = set(gridDevelIds)
-            for i in range(len(gridIds)):
-                if gridIds[i] in gridTrainIds:
-                    cv[0][0].append(i)
-                else:
-                    cv[0][1].append(i)
-            clf = GridSearchCV(self.Classifier(), classifierArgs, "f1", n_jobs=self.n_jobs, cv=cv, refit=False)
-            clf.fit(gridFeatures, gridLabels)
-            print "Best params", (clf.best_params_, clf.best_score_)
-            examples["label_args"][labelName] = clf.best_params_
-            print "Predicting"
-            clf, data = self.learnSet(clf.best_params_, examples, ["train"], ["devel"], terms, None, negatives, True, "binary")
-            predictions["devel"].append(data["predicted"])
+        setNames = ["devel"] + (["test"] if useTestSet else []) + (["cafa"] if useCAFASet else [])
+        print "Labels:", len(labelNames)
+        gridIndices = getSubsetIndices(examples, ["train", "devel"])
+        isTrain = examples["set_masks"].get("train", np.zeros(len(examples["sets"]), dtype=bool))[gridIndices]
+        data = {"cv":[(np.flatnonzero(isTrain), np.flatnonzero(~isTrain))], "setNames":setNames, "features":{}, "labels":{}}
+        data["gridFeatures"] = examples["features"][gridIndices]
+        data["gridLabels"] = np.asfortranarray(toDense(examples["labels"][gridIndices]))
+        for setName in ["train"] + setNames:
+            indices = getSubsetIndices(examples, [setName])
+            data["features"][setName] = examples["features"][indices]
+            if setName in ("train", "devel"):
+                data["labels"][setName] = np.asfortranarray(toDense(examples["labels"][indices]))
+        predictions = {x:np.zeros((data["features"][x].shape[0], len(labelNames)), dtype=int) for x in setNames}
+        tempDir = tempfile.mkdtemp(prefix="labels-")
+        pool = None
+        try:
+            dataPath = os.path.join(tempDir, "data.dump")
+            joblib.dump(data, dataPath)
             data = None
-            #if outDir != None:
-            #    predictions["devel"].append(self.predictSets(examples, clf, ["devel"], terms, None, negatives, True)["predicted"])
-            #    #predictions["devel"] += self.catenateLabels(predictions["devel"], self.predictSets(examples, clf, ["devel"], terms, None, negatives, True)["predicted"])
-            if useTestSet:
-                predictions["test"].append(self.predictSets(examples, clf, ["test"], terms, None, negatives, True, "binary")["predicted"])
-            if useCAFASet:
-                predictions["cafa"].append(self.predictSets(examples, clf, ["cafa"], terms, None, negatives, True, "binary")["predicted"])
-        #print predictions
+            numProcesses = self.n_jobs if self.n_jobs > 0 else cpu_count()
+            if numProcesses > 1:
+                print "Learning", len(labelNames), "labels using", numProcesses, "processes"
+                pool = Pool(numProcesses, _initLabelWorker, (self.Classifier, classifierArgs, dataPath))
+                results = pool.imap(_learnLabel, range(len(labelNames)), chunksize=1)
+            else:
+                _initLabelWorker(self.Classifier, classifierArgs, dataPath)
+                results = itertools.imap(_learnLabel, range(len(labelNames)))
+            for labelIndex, bestParams, labelPredictions, output in results:
+                labelName = labelNames[labelIndex]
+                print "===", "Parameter search for label", labelIndex, terms[labelName], "==="
+                sys.stdout.write(output)
+                examples["label_args"][labelName] = bestParams
+                for setName in setNames:
+                    predictions[setName][:, labelIndex] = labelPredictions[setName]
+        finally:
+            if pool != None:
+                pool.terminate()
+            _labelWorker.clear()
+            shutil.rmtree(tempDir)
         print "Parameter grid search complete"
-        examples["labels"] = origLabels
-        examples["label_names"] = origLabelNames
         if outDir != None:
-            self.predictSets(examples, None, ["devel"], terms, outDir, negatives, predictions=np.dstack(predictions["devel"])[0])
+            self.predictSets(examples, None, ["devel"], terms, outDir, negatives, predictions=predictions["devel"])
         if useTestSet:
-            self.predictSets(examples, None, ["test"], terms, outDir, negatives, predictions=np.dstack(predictions["test"])[0])
+            self.predictSets(examples, None, ["test"], terms, outDir, negatives, predictions=predictions["test"])
         if useCAFASet:
-            self.predictSets(examples, None, ["cafa"], terms, outDir, negatives, predictions=np.dstack(predictions["cafa"])[0])
+            self.predictSets(examples, None, ["cafa"], terms, outDir, negatives, predictions=predictions["cafa"])
 #                 
 #         for predictedSet in ("devel", "test", "cafa"):
 #             results
@@ -3,12 +3,14 @@ from collections import defaultdict
 import evaluateFile
 import loading
 import evaluation
+import ontology
 import sys, os
 import classification
 import shutil
 from utils import Stream
 from sklearn.grid_search import GridSearchCV
 import itertools
+import numpy as np
 from sklearn.preprocessing.data import minmax_scale, MinMaxScaler
 
 def clearKeys(proteins, keys):
@@ -141,6 +143,10 @@ def buildExamples(proteins, predKeys, limitToSets=None, limitTerms=None, outDir=
     examples["features"] = dv.fit_transform(examples["features"])
     examples["feature_names"] = dv.feature_names_
     print "Vectorized the examples, unique features =", len(examples["feature_names"])
+    examples["classes"] = np.array(examples["classes"])
+    for key in ("sets", "proteins", "labels"):
+        examples[key] = loading.toObjectArray(examples[key])
+    examples["set_masks"] = loading.getSetMasks(examples["sets"])
     if outDir != None:
         loading.saveFeatureNames(examples["feature_names"], os.path.join(outDir, "features.tsv"))
     return examples
@@ -148,12 +154,11 @@ def buildExamples(proteins, predKeys, limitToSets=None, limitTerms=None, outDir=
 def getSubset(examples, setNames):
     subset = {}
     counts = {}
-    sets = examples["sets"]
-    indices = [i for i in range(len(sets)) if any(x in setNames for x in sets[i])]
+    indices = loading.getSubsetIndices(examples, setNames)
     subset["features"] = examples["features"][indices]
     counts["features"] = subset["features"].shape[0] 
     for key in ("classes", "sets", "proteins", "labels"):
-        subset[key] = [examples[key][i] for i in indices]
+        subset[key] = examples[key][indices]
         counts[key] = len(subset[key])
     print "Generated example subset for sets", setNames, "with", counts
     return subset
@@ -179,7 +184,7 @@ def learn(examples, Classifier, classifierArgs, develFolds=10, verbose=3, n_jobs
     minMax = MinMaxScaler((0.03, 1.0))
     allPredictions = clf.predict(examples["features"])
     if hasattr(clf, "predict_proba"):
-        allProbabilities = clf.predict_proba(examples["features"])
+        allProbabilities = classification.getPositiveProbabilities(clf, clf.predict_proba(examples["features"]))[:, 0]
     else:
         allProbabilities = clf.decision_function(examples["features"])
         #import pdb; pdb.set_trace()
@@ -189,7 +194,7 @@ def learn(examples, Classifier, classifierArgs, develFolds=10, verbose=3, n_jobs
     testExamples = getSubset(examples, ["test"])
     testPredictions = clf.predict(testExamples["features"])
     if hasattr(clf, "predict_proba"):
-        testProbabilities = clf.predict_proba(testExamples["features"])
+        testProbabilities = classification.getPositiveProbabilities(clf, clf.predict_proba(testExamples["features"]))[:, 0]
     else:
         testProbabilities = clf.decision_function(testExamples["features"])
         testProbabilities = minMax.transform(testProbabilities)
@@ -228,11 +233,19 @@ def combine(dataPath, nnInput, clsInput, outDir=None, classifier=None, classifie
     print "Proteins:", len(proteins)
     if task == "cafa3hpo":
         loading.removeNonHuman(proteins)
-        termCounts = loading.loadHPOAnnotations(os.path.join(options.dataPath, "HPO", "annotation", "all_cafa_annotation_propagated.tsv.gz"), proteins)
+        annotationPath = os.path.join(options.dataPath, "HPO", "annotation", "all_cafa_annotation_propagated.tsv.gz")
+        termPairPath = os.path.join(options.dataPath, "HPO", "ontology", "hp.obo")
+        termCounts = loading.loadHPOAnnotations(annotationPath, proteins)
     elif task == "cafa3":
-        termCounts = loading.loadAnnotations(os.path.join(options.dataPath, "data", "Swissprot_propagated.tsv.gz"), proteins)
+        annotationPath = os.path.join(options.dataPath, "data", "Swissprot_propagated.tsv.gz")
+        termPairPath = os.path.join(options.dataPath, "data", "parent_term2term.txt.gz")
+        termCounts = loading.loadAnnotations(annotationPath, proteins)
     else:
-        termCounts = loading.loadAnnotations(os.path.join(options.dataPath, "CAFA_PI", "Swissprot", "CAFA_PI_Swissprot_propagated.tsv.gz"), proteins)
+        annotationPath = os.path.join(options.dataPath, "CAFA_PI", "Swissprot", "CAFA_PI_Swissprot_propagated.tsv.gz")
+        termPairPath = os.path.join(options.dataPath, "data", "parent_term2term.txt.gz")
+        termCounts = loading.loadAnnotations(annotationPath, proteins)
+    ic = ontology.getIC(annotationPath, termPairPath, "HPO" if task == "cafa3hpo" else "GO", outDir) if os.path.exists(termPairPath) else None
+    ontologyIndex = ontology.OntologyIndex(ontology.loadTermPairs(termPairPath)) if useCafa and os.path.exists(termPairPath) else None
     print "Unique terms:", len(termCounts)
     topTerms = loading.getTopTerms(termCounts, numTerms)
     limitTerms=set([x[0] for x in topTerms])
@@ -277,9 +290,12 @@ def combine(dataPath, nnInput, clsInput, outDir=None, classifier=None, classifie
                     loading.vectorizeExamples(examples, None, sparseLabels=True)
                     results = evaluation.evaluate(examples["labels"], examples["predictions"], examples, terms=None, averageOnly=True, noAUC=True)
                     print "Average for", str(combination) + "/" + setName + "/" + mode + ":", evaluation.metricsToString(results["average"])
+                    print "CAFA for", str(combination) + "/" + setName + "/" + mode + ":", evaluation.cafaToString(evaluation.evaluateCAFA(examples["labels"], evaluateFile.makeConfidences(proteins, examples, combConfKey), ic.getArray(examples["label_names"]) if ic != None else None))
                     #else:
                     #    print "Skipping evaluation for set '" + setName + "'"
                     if useOutFiles:
+                        if setName == "cafa" and ontologyIndex != None:
+                            ontology.propagateProteins(proteins, combKey, ontologyIndex, limitTerms, limitToSets=[setName])
                         combString = "-".join(combination)
                         outPath = os.path.join(outDir, "-".join([combString, setName, mode, "ensemble"]) + ".tsv.gz")
                         evaluation.saveProteins(proteins, outPath, limitTerms=limitTerms, limitToSets=[setName], predKey=combKey) #pass#evaluation.saveResults(data, outStem, label_names, negatives)
@@ -4,7 +4,10 @@ from collections import defaultdict
 import gzip
 import csv
 import evaluation
+import ontology
 import operator
+import numpy as np
+import scipy.sparse
 
 def makeExamples(proteins, limitTerms, limitToSets=None, predKey="predictions"):
     print "Converting proteins to examples"
@@ -42,6 +45,22 @@ def makeExamples(proteins, limitTerms, limitToSets=None, predKey="predictions"):
     print "Converted", len(proteins), "proteins into", len(examples["labels"]), "examples, filtered terms:", {x:len(filtered[x]) for x in filtered}
     return examples
 
+def makeConfidences(proteins, examples, confKey):
+    """
+    A sparse matrix of the prediction confidences with the rows and columns of the vectorized
+    examples, for the CAFA evaluation.
+    """
+    labelIndices = {examples["label_names"][i]:i for i in range(len(examples["label_names"]))}
+    rows, cols, values = [], [], []
+    for i in range(len(examples["ids"])):
+        confs = proteins[examples["ids"][i]].get(confKey, {})
+        for label in confs:
+            if label in labelIndices:
+                rows.append(i)
+                cols.append(labelIndices[label])
+                values.append(confs[label])
+    return scipy.sparse.csr_matrix((np.array(values, dtype=np.float64), (rows, cols)), shape=(len(examples["ids"]), len(labelIndices)))
+
 def limitExamples(examples, limitToSets):
     indices = [i for i in range(len(examples["sets"])) if any(x in limitToSets for x in examples["sets"][i])]
     print "Limiting", examples["labels"].shape[0], "to", len(indices)
@@ -98,7 +117,7 @@ def loadPredictions(proteins, inPath, limitToSets, readGold=True, predKey="predi
 def getTopTerms(counts, num=1000):
     return sorted(counts.items(), key=operator.itemgetter(1), reverse=True)[0:num]
 
-def evaluateFile(inPath, dataPath, setNames, numTerms=5000, cafaTargets="skip", useHPO=False, detailed=False):
+def evaluateFile(inPath, dataPath, setNames, numTerms=5000, cafaTargets="skip", useHPO=False, detailed=False, cacheDir=None):
     assert cafaTargets in ("skip", "overlap", "separate", "external")
     print "==========", "Evaluating", "=========="
     terms = None
@@ -116,16 +135,20 @@ def evaluateFile(inPath, dataPath, setNames, numTerms=5000, cafaTargets="skip",
     print "Proteins:", len(proteins)
     if useHPO:
         loading.removeNonHuman(proteins)
-        termCounts = loading.loadHPOAnnotations(os.path.join(options.dataPath, "HPO", "annotation", "all_cafa_annotation_propagated.tsv.gz"), proteins)
+        annotationPath = os.path.join(options.dataPath, "HPO", "annotation", "all_cafa_annotation_propagated.tsv.gz")
+        termPairPath = os.path.join(options.dataPath, "HPO", "ontology", "hp.obo")
+        termCounts = loading.loadHPOAnnotations(annotationPath, proteins)
     else:
-        termCounts = loading.loadAnnotations(os.path.join(options.dataPath, "data", "Swissprot_propagated.tsv.gz"), proteins)
+        annotationPath = os.path.join(options.dataPath, "data", "Swissprot_propagated.tsv.gz")
+        termPairPath = os.path.join(options.dataPath, "data", "parent_term2term.txt.gz")
+        termCounts = loading.loadAnnotations(annotationPath, proteins)
     print "Unique terms:", len(termCounts)
     topTerms = getTopTerms(termCounts, numTerms)
     print "Using", len(topTerms), "most common GO terms"
     loading.loadSplit(os.path.join(options.dataPath, "data"), proteins, allowMissing=useHPO)
     loading.defineSets(proteins, cafaTargets)
     
-    loadPredictions(proteins, inPath, setNames)
+    loadPredictions(proteins, inPath, setNames, confKey="predictions_conf")
     examples = makeExamples(proteins, limitTerms=set([x[0] for x in topTerms]), predKey="predictions")
     #print "labels", examples["labels"][0:500]
     #print "predictions", examples["predictions"][0:500]
@@ -133,6 +156,10 @@ def evaluateFile(inPath, dataPath, setNames, numTerms=5000, cafaTargets="skip",
     limitExamples(examples, setNames)
     results = evaluation.evaluate(examples["labels"], examples["predictions"], examples, terms=terms, averageOnly=not detailed, noAUC=True)
     print setNames, "average:", evaluation.metricsToString(results["average"])
+    ic = None
+    if os.path.exists(termPairPath):
+        ic = ontology.getIC(annotationPath, termPairPath, "HPO" if useHPO else "GO", cacheDir).getArray(examples["label_names"])
+    print setNames, "CAFA:", evaluation.cafaToString(evaluation.evaluateCAFA(examples["labels"], makeConfidences(proteins, examples, "predictions_conf"), ic))
     if detailed:
         print "------", "Detailed results", "------"
         print evaluation.getResultsString(results, 20, ["average"])
@@ -149,7 +176,8 @@ if __name__=="__main__":
     optparser.add_option("--targets", default="skip", help="How to include the CAFA target proteins, one of 'skip', 'overlap' or 'separate'")
     optparser.add_option("--hpo", default=False, action="store_true")
     optparser.add_option("--detailed", default=False, action="store_true")
+    optparser.add_option("--cacheDir", default=None, help="A directory for caching the information content of the ontology terms")
     (options, args) = optparser.parse_args()
     
     options.setNames = [x.strip() for x in options.setNames.split(",")]
-    evaluateFile(options.input, options.dataPath, options.setNames, options.terms, cafaTargets=options.targets, useHPO=options.hpo, detailed=options.detailed)
\ No newline at end of file
+    evaluateFile(options.input, options.dataPath, options.setNames, options.terms, cafaTargets=options.targets, useHPO=options.hpo, detailed=options.detailed, cacheDir=options.cacheDir)
\ No newline at end of file
@@ -1,22 +1,35 @@
 import csv
 import numpy as np
+import scipy.sparse
 import gzip
-from sklearn.metrics import roc_auc_score, f1_score, precision_score, recall_score
+from sklearn.metrics import roc_auc_score
 from collections import defaultdict
 
-def evaluate(labels, predicted, examples, terms=None, averageOnly=False, average="micro", noAUC=False):
+def evaluate(labels, predicted, examples, terms=None, averageOnly=False, average="micro", noAUC=False, probabilities=None):
+    """
+    Evaluate the predictions against the gold labels. The per-label tp/fp/fn/tn counts are 
+    computed once and the average and per-label scores are derived from them. The AUC is 
+    calculated from the probabilities of the positive class, and is None if they are not given.
+    """
     print "Evaluating the predictions"
     results = {}
     print "Calculating average scores"
-    results["average"] = {"id":"average", "ns":None, "name":None, "auc":0, "tp":None, "fp":None, "fn":None, "tn":None}
-    if not noAUC:
+    results["average"] = {"id":"average", "ns":None, "name":None, "auc":None, "tp":None, "fp":None, "fn":None, "tn":None}
+    if len(labels.shape) == 1: # Binary classification
+        labels = labels.reshape((-1, 1))
+        predicted = predicted.reshape((-1, 1))
+        if probabilities is not None:
+            probabilities = probabilities.reshape((-1, 1))
+    counts = getLabelCounts(labels, predicted)
+    if not noAUC and probabilities is not None:
         try:
-            results["average"]["auc"] = roc_auc_score(labels, predicted, average="micro")
+            results["average"]["auc"] = roc_auc_score(toDense(labels), probabilities, average="micro")
         except ValueError as e:
             print e
-    results["average"]["fscore"] = f1_score(labels, predicted, average=average)
-    results["average"]["precision"] = precision_score(labels, predicted, average=average)
-    results["average"]["recall"] = recall_score(labels, predicted, average=average)
+    precision, recall, fscore = getScores(counts, average=average)
+    results["average"]["fscore"] = fscore
+    results["average"]["precision"] = precision
+    results["average"]["recall"] = recall
     if averageOnly:
         return results
     
@@ -24,19 +37,20 @@ def evaluate(labels, predicted, examples, terms=None, averageOnly=False, average
     label_names = examples["label_names"]
     label_size = examples.get("label_size")
     label_args = examples.get("label_args")
-    try:
-        aucs = roc_auc_score(labels, predicted, average=None)
-    except (TypeError, ValueError) as e:
-        print e
-        aucs = [0] * len(label_names)
-    fscores = f1_score(labels, predicted, average=None)
-    precisions = precision_score(labels, predicted, average=None)
-    recalls = recall_score(labels, predicted, average=None)
+    aucs = [None] * len(label_names)
+    if not noAUC and probabilities is not None:
+        try:
+            aucs = getLabelAUCs(toDense(labels), probabilities)
+        except (TypeError, ValueError) as e:
+            print e
+    precisions, recalls, fscores = getScores(counts, average=None)
     lengths = [len(x) for x in (aucs, fscores, precisions, recalls, label_names)]
     assert len(set(lengths)) == 1, lengths
-    for auc, fscore, precision, recall, label_name in zip(aucs, fscores, precisions, recalls, label_names):
+    for i in range(len(label_names)):
+        label_name = label_names[i]
         assert label_name not in results
-        result = {"id":label_name, "ns":None, "name":None, "auc":auc, "precision":precision, "recall":recall, "fscore":fscore, "tp":0, "fp":0, "fn":0, "tn":0}
+        result = {"id":label_name, "ns":None, "name":None, "auc":aucs[i], "precision":precisions[i], "recall":recalls[i], "fscore":fscores[i]}
+        result.update({x:int(counts[x][i]) for x in counts})
         results[label_name] = result
         if label_size != None and label_name in label_size:
             result["label_size"] = label_size[label_name]
@@ -46,16 +60,148 @@ def evaluate(labels, predicted, examples, terms=None, averageOnly=False, average
             term = terms[label_name]
             result["ns"] = term["ns"]
             result["name"] = term["name"]
-    print "Counting label instances"
-    stats = {x:{"tp":0, "fp":0, "fn":0, "tn":0} for x in label_names}
-    label_indices = range(len(label_names))
-    for gold, pred in zip(labels, predicted):
-        for i in label_indices:
-            stats[label_names[i]][getMatch(gold[i], pred[i])] += 1
-    for key in stats:
-        results[key].update(stats[key])
     return results
 
+def getLabelAUCs(labels, probabilities):
+    """
+    The ROC AUC of the probabilities for each label. The AUC is not defined and is left at 
+    zero for labels with only one class in the gold labels.
+    """
+    aucs = np.zeros(labels.shape[1])
+    for i in range(labels.shape[1]):
+        if labels[:, i].min() != labels[:, i].max():
+            aucs[i] = roc_auc_score(labels[:, i], probabilities[:, i])
+    return aucs
+
+def toDense(matrix):
+    return matrix.toarray() if hasattr(matrix, "toarray") else matrix
+
+def divideCounts(numerator, denominator):
+    """
+    Elementwise division of the counts, with zero where the denominator is zero.
+    """
+    denominator = np.asarray(denominator, dtype=np.float64)
+    result = np.asarray(numerator, dtype=np.float64) / np.where(denominator == 0, 1.0, denominator)
+    result[denominator == 0] = 0.0
+    return result
+
+def getScores(counts, average="micro"):
+    """
+    Precision, recall and F-score from the per-label counts returned by getLabelCounts. The
+    average is one of "micro", "macro" or "binary" (for a single label) as in scikit-learn, 
+    or None for the per-label score arrays.
+    """
+    tp, fp, fn = counts["tp"], counts["fp"], counts["fn"]
+    if average == "micro":
+        tp, fp, fn = [np.array([x.sum()]) for x in (tp, fp, fn)]
+    elif average == "binary" and len(tp) != 1:
+        raise ValueError("Binary average requires a single label, got " + str(len(tp)))
+    elif average not in (None, "macro", "binary"):
+        raise ValueError("Unsupported average '" + str(average) + "'")
+    precision = divideCounts(tp, tp + fp)
+    recall = divideCounts(tp, tp + fn)
+    denominator = precision + recall
+    denominator[denominator == 0] = 1
+    fscore = 2 * precision * recall / denominator
+    if average != None:
+        return [np.mean(x) for x in (precision, recall, fscore)]
+    return precision, recall, fscore
+
+def getLabelCounts(labels, predicted):
+    """
+    The tp, fp, fn and tn counts of each label (column) as arrays. The labels and predictions
+    can be dense arrays or sparse matrices, which are not densified.
+    """
+    if hasattr(labels, "tocsr"):
+        labels = labels.tocsr() != 0
+    else:
+        labels = np.asarray(labels) != 0
+    if hasattr(predicted, "tocsr"):
+        predicted = predicted.tocsr() != 0
+    else:
+        predicted = np.asarray(predicted) != 0
+    numExamples = labels.shape[0]
+    goldCounts = np.asarray(labels.sum(axis=0)).ravel()
+    predCounts = np.asarray(predicted.sum(axis=0)).ravel()
+    if hasattr(labels, "multiply"):
+        tp = np.asarray(labels.multiply(predicted).sum(axis=0)).ravel()
+    elif hasattr(predicted, "multiply"):
+        tp = np.asarray(predicted.multiply(labels).sum(axis=0)).ravel()
+    else:
+        tp = np.logical_and(labels, predicted).sum(axis=0)
+    fn = goldCounts - tp
+    fp = predCounts - tp
+    return {"tp":tp, "fp":fp, "fn":fn, "tn":numExamples - tp - fp - fn}
+
+def evaluateCAFA(labels, confidences, ic=None, numThresholds=100):
+    """
+    Protein-centric CAFA evaluation of confidence scored predictions. The labels and confidences
+    are (sparse) matrices of proteins x terms, with zero for the terms that are not predicted.
+    Precision, recall and the remaining and misinformation (using the information content ic
+    of each term, if given) are calculated at numThresholds thresholds in one pass over the 
+    predictions, and the Fmax and Smin with their thresholds are returned. Only the proteins 
+    with gold annotations are evaluated, as in CAFA.
+    """
+    labels = scipy.sparse.csr_matrix(labels)
+    labels.eliminate_zeros()
+    confidences = scipy.sparse.coo_matrix(confidences)
+    assert labels.shape == confidences.shape, (labels.shape, confidences.shape)
+    thresholds = np.arange(1, numThresholds + 1) / float(numThresholds)
+    goldCounts = np.diff(labels.indptr)
+    benchmark = np.flatnonzero(goldCounts > 0)
+    result = {"fmax":0.0, "precision":0.0, "recall":0.0, "threshold":None, "coverage":0.0, "smin":None, "smin_threshold":None, "proteins":len(benchmark)}
+    if len(benchmark) == 0:
+        return result
+    # Map the predictions of the benchmark proteins to rows and thresholds
+    rowMap = np.full(labels.shape[0], -1, dtype=np.int64)
+    rowMap[benchmark] = np.arange(len(benchmark))
+    mask = (confidences.data > 0) & (rowMap[confidences.row] >= 0)
+    rows, cols, values = rowMap[confidences.row[mask]], confidences.col[mask], confidences.data[mask]
+    # The number of thresholds at or below each confidence
+    steps = np.searchsorted(thresholds, values, side="right")
+    numCols = labels.shape[1]
+    goldKeys = np.repeat(np.arange(labels.shape[0], dtype=np.int64), goldCounts) * numCols + labels.indices
+    isTrue = np.in1d(benchmark[rows] * numCols + cols, goldKeys)
+    cells = rows * (numThresholds + 1) + steps
+    predCounts = getThresholdSums(cells, None, len(benchmark), numThresholds)
+    tpCounts = getThresholdSums(cells, isTrue.astype(np.float64), len(benchmark), numThresholds)
+    # Precision is averaged over the proteins with predictions, recall over all the proteins
+    hasPred = predCounts > 0
+    numPredicted = hasPred.sum(axis=0)
+    precisions = divideCounts((tpCounts / np.where(hasPred, predCounts, 1)).sum(axis=0), numPredicted)
+    recalls = (tpCounts / goldCounts[benchmark].reshape((-1, 1))).sum(axis=0) / len(benchmark)
+    denominator = precisions + recalls
+    fscores = 2 * precisions * recalls / np.where(denominator == 0, 1, denominator)
+    best = int(np.argmax(fscores))
+    result.update({"fmax":fscores[best], "precision":precisions[best], "recall":recalls[best], "threshold":thresholds[best], "coverage":numPredicted[best] / float(len(benchmark))})
+    if ic is not None:
+        ic = np.asarray(ic, dtype=np.float64)
+        predIC = getThresholdSums(cells, ic[cols], len(benchmark), numThresholds)
+        tpIC = getThresholdSums(cells, ic[cols] * isTrue, len(benchmark), numThresholds)
+        goldIC = np.bincount(np.repeat(np.arange(labels.shape[0]), goldCounts), weights=ic[labels.indices], minlength=labels.shape[0])[benchmark]
+        remaining = (goldIC.reshape((-1, 1)) - tpIC).sum(axis=0) / len(benchmark)
+        misinformation = (predIC - tpIC).sum(axis=0) / len(benchmark)
+        sValues = np.sqrt(remaining ** 2 + misinformation ** 2)
+        best = int(np.argmin(sValues))
+        result.update({"smin":sValues[best], "smin_threshold":thresholds[best], "remaining":remaining[best], "misinformation":misinformation[best]})
+    return result
+
+def getThresholdSums(cells, weights, numRows, numThresholds):
+    """
+    Sum the weights of the predictions into a rows x thresholds matrix, where the column j is 
+    the sum over the predictions of the row with a confidence of at least the j-th threshold. 
+    The cells are row * (numThresholds + 1) + the number of thresholds at or below the confidence.
+    """
+    sums = np.bincount(cells, weights=weights, minlength=numRows * (numThresholds + 1)).reshape((numRows, numThresholds + 1))
+    return np.cumsum(sums[:, ::-1], axis=1)[:, ::-1][:, 1:]
+
+def cafaToString(result, style="%.3f"):
+    s = "Fmax|p/r|t = " + style % result["fmax"] + "|" + style % result["precision"] + "/" + style % result["recall"] + "|" + str(result["threshold"])
+    if result.get("smin") != None:
+        s += ", Smin|t = " + style % result["smin"] + "|" + str(result["smin_threshold"])
+    s += ", coverage = " + style % result["coverage"] + " of " + str(result["proteins"])
+    return s
+
 def resultIsBetter(original, new, key="average"):
     if new[key]["fscore"] != original[key]["fscore"]:
         return new[key]["fscore"] > original[key]["fscore"]
@@ -71,7 +217,7 @@ def metricsToString(result, style="%.3f"):
     s = "a/f|p/r"
     if hasCounts:
         s += "|tp/fp/tn/fn"
-    s += " = " + style % result["auc"] + "/" + style % result["fscore"] + "|" + style % result["precision"] + "/" + style % result["recall"]
+    s += " = " + (style % result["auc"] if result.get("auc") != None else "-") + "/" + style % result["fscore"] + "|" + style % result["precision"] + "/" + style % result["recall"]
     if hasCounts:
         s += "|" + "/".join([str(result.get(x, "-")) for x in ("tp", "fp", "tn", "fn")])
     return s
@@ -194,43 +340,67 @@ def getMatch(gold, predicted):
     else:
         return "fn" if (gold == 1) else "fp"
 
-def savePredictions(data, label_names, outPath, negatives=False):
+def formatField(value):
+    """
+    Format a value the way csv.writer writes it into the tab-separated prediction files
+    """
+    if value is None:
+        return ""
+    text = repr(value) if isinstance(value, float) else str(value)
+    if any(c in text for c in ("\t", '"', "\r", "\n")):
+        text = '"' + text.replace('"', '""') + '"'
+    return text
+
+def formatValues(values):
+    """
+    Format an array of values into an object array of strings, formatting each
+    distinct value only once
+    """
+    if len(values) == 0:
+        return np.zeros(0, dtype=object)
+    uniques, inverse = np.unique(values, return_inverse=True)
+    return np.array([formatField(x) for x in uniques], dtype=object)[inverse]
+
+def savePredictions(data, label_names, outPath, negatives=False, chunkSize=1000000):
+    """
+    Write the per-label predictions in tab-separated format. The rows are selected
+    with np.nonzero on the gold and predicted matrices and formatted and written
+    one chunk of proteins at a time.
+    """
     print "Writing predictions to", outPath
     keys = ["ids", "gold", "predicted", "cafa_ids"]
-    hasProbabilities = data.get("probabilities") != None
+    hasProbabilities = data.get("probabilities") is not None
     if hasProbabilities:
-        lengths = [len(data["probabilities"]), len(label_names)]
-        assert len(set(lengths)) == 1, lengths #keys += ["probabilities"]
-    lengths = [len(data[x]) for x in keys]
+        lengths = [data["probabilities"].shape[1], len(label_names)]
+        assert len(set(lengths)) == 1, lengths
+    lengths = [len(data[x]) if not scipy.sparse.issparse(data[x]) else data[x].shape[0] for x in keys]
     assert len(set(lengths)) == 1, lengths
-    label_indices = range(len(label_names))
-    
-#     n_samples = data["probabilities"][0].shape[0]
-#     label_names_array = np.array(label_names)
-#     n_outputs = len(label_names_array)
-#     predictions = np.zeros((n_samples, n_outputs))
-#     for k in range(n_outputs):
-#         predictions[:, k] = label_names_array[k].take(np.argmax(data["probabilities"][k], axis=1), axis=0)
-    
+    numLabels = len(label_names)
+    ids = np.array([formatField(x) for x in data["ids"]], dtype=object)
+    cafaIds = np.array([formatField(",".join(x)) for x in data["cafa_ids"]], dtype=object)
+    labelIndices = np.array([str(x) for x in range(numLabels)], dtype=object)
+    labelNames = np.array([formatField(x) for x in label_names], dtype=object)
+    columns = ["id", "label_index", "label", "predicted", "confidence", "gold", "match", "cafa_ids"]
+    chunkRows = max(1, chunkSize // max(1, numLabels))
     with gzip.open(outPath, "wt") as f:
-        dw = csv.DictWriter(f, ["id", "label_index", "label", "predicted", "confidence", "gold", "match", "cafa_ids"], delimiter='\t')
-        dw.writeheader()
-        rows = []
-        for i in range(len(data["ids"])):
-            gold = data["gold"][i]
-            pred = data["predicted"][i]
-            cafa_ids = ",".join(data["cafa_ids"][i])
-            for labelIndex in label_indices:
-                goldValue = gold[labelIndex]
-                predValue = int(pred[labelIndex])
-                if negatives or (goldValue == 1 or predValue == 1):
-                    row = {"id":data["ids"][i], "label_index":labelIndex, "label":label_names[labelIndex], "gold":goldValue, "predicted":predValue, "cafa_ids":cafa_ids}
-                    row["match"] = getMatch(goldValue, predValue)
-                    row["confidence"] = max(data["probabilities"][labelIndex][i]) if hasProbabilities else None #data["probabilities"][labelIndex][i] if hasProbabilities else None
-                    #row["pred2"] = predictions[i][labelIndex]
-                    rows.append(row)
-            if len(rows) >= 100000:
-                dw.writerows(rows)
-                rows = []
-        if len(rows) >= 0:
-            dw.writerows(rows)
\ No newline at end of file
+        f.write("\t".join(columns) + "\r\n")
+        for start in range(0, lengths[0], chunkRows):
+            end = min(start + chunkRows, lengths[0])
+            gold = toDense(data["gold"][start:end])
+            pred = toDense(data["predicted"][start:end]).astype(int)
+            if negatives:
+                rows, cols = np.nonzero(np.ones(gold.shape, dtype=bool))
+            else:
+                rows, cols = np.nonzero((gold == 1) | (pred == 1))
+            if len(rows) == 0:
+                continue
+            goldValues = gold[rows, cols]
+            predValues = pred[rows, cols]
+            isGold = goldValues == 1
+            match = np.where(goldValues == predValues, np.where(isGold, "tp", "tn"), np.where(isGold, "fn", "fp")).astype(object)
+            if hasProbabilities:
+                confidences = formatValues(data["probabilities"][start + rows, cols])
+            else:
+                confidences = np.array([""], dtype=object)[np.zeros(len(rows), dtype=int)]
+            lines = ids[start + rows] + "\t" + labelIndices[cols] + "\t" + labelNames[cols] + "\t" + formatValues(predValues) + "\t" + confidences + "\t" + formatValues(goldValues) + "\t" + match + "\t" + cafaIds[start + rows] + "\r\n"
+            f.write("".join(lines))
@@ -1,25 +1,96 @@
+import sys
 import gzip
 import csv
 import re
 import os
+import hashlib
+import numpy as np
+from multiprocessing import Pool, current_process
+from cStringIO import StringIO
+from array import array
+from loading import StreamVectorizer, FeatureRow, ProteinIndex
+try:
+    import pandas
+except ImportError:
+    pandas = None
 
 ###############################################################################
 # Base Classes
 ###############################################################################
 
 class FeatureBuilder:
+    # Attributes which are not settings of the builder and are left out of the cache key
+    cacheKeyExclude = ("debug", "fileJobs", "chunkSize", "sortedInput", "numProteins", "coverage", "covered", "data", "mapping")
+    
     def __init__(self, debug=False):
         self.debug = debug
     
-    def build(self, proteins):
+    def build(self, proteins, proteinIndex=None):
         pass
     
     def setDataPath(self, dataPath):
         pass
     
+    def getInputPaths(self):
+        return []
+    
+    def getCacheKey(self, protIds):
+        """
+        A hash of the builder class, its settings, the input files (paths, modification times
+        and sizes) and the protein ids. Built features can be reused while the key stays the same.
+        """
+        settings = [(key, self._getKeyValue(self.__dict__[key])) for key in sorted(self.__dict__.keys()) if key not in self.cacheKeyExclude]
+        inputs = []
+        for inPath in self.getInputPaths():
+            stat = os.stat(inPath)
+            inputs.append((inPath, stat.st_mtime, stat.st_size))
+        key = hashlib.sha1()
+        key.update(repr((self.__class__.__module__, self.__class__.__name__, settings, inputs)))
+        for protId in protIds:
+            key.update(protId + "\n")
+        return key.hexdigest()
+    
+    def _getKeyValue(self, value):
+        if isinstance(value, (list, tuple)):
+            return [self._getKeyValue(x) for x in value]
+        elif isinstance(value, dict):
+            return [(x, self._getKeyValue(value[x])) for x in sorted(value.keys())]
+        elif hasattr(value, "pattern"): # A compiled regular expression
+            return value.pattern
+        return value
+    
     def setFeature(self, protein, feature, value=1):
         protein["features"][feature] = value
     
+    def setPrefixedFeature(self, features, prefix, key, value):
+        """
+        Set the feature prefix + key. With a vectorized feature row the key is interned
+        under the prefix, so the name string is not built for every assignment.
+        """
+        if isinstance(features, FeatureRow):
+            features.setPrefixed(prefix, key, value)
+        else:
+            features[prefix + key] = value
+    
+    def setFeatureValues(self, features, names, values, prefix=None):
+        """
+        Set the feature names[i] with the value values[i] for each feature row features[i]. The
+        names or the values can also be a single value shared by all rows. If prefix is defined,
+        the feature names are prefix + names[i].
+        """
+        if np.isscalar(values):
+            values = [values] * len(features)
+        vectorizer = features[0].vectorizer if len(features) > 0 and isinstance(features[0], FeatureRow) else None
+        if vectorizer != None and all(isinstance(x, FeatureRow) and x.vectorizer is vectorizer for x in features):
+            vectorizer.addValues([x.index for x in features], names, values, prefix)
+        else:
+            if isinstance(names, basestring):
+                names = [names] * len(features)
+            if prefix != None:
+                names = [prefix + name for name in names]
+            for rowFeatures, name, value in zip(features, names, np.asarray(values).tolist()):
+                rowFeatures[name] = value
+    
     def getMatchingPaths(self, inPaths, patterns):
         matching = []
         for inPath in inPaths:
@@ -54,11 +125,44 @@ class FeatureBuilder:
     
     def finishCoverage(self):
         #print self.__class__.__name__, "coverage =", float(len(self.coveredIds)) / self.numProteins, "included/total =" [len(self.coveredIds), self.numProteins]
+        self.covered = self.coverage["total"]
         counts = {x:len(self.coverage[x]) for x in self.coverage}
         print self.__class__.__name__, "coverage (included, all, fraction) =", {x:(counts.get(x, 0), self.numProteins[x], float(counts.get(x, 0)) / self.numProteins[x]) for x in sorted(self.numProteins.keys())}
         self.numProteins = None
         self.coverage = None 
 
+###############################################################################
+# Per-file Worker Processes
+###############################################################################
+
+_fileWorker = {}
+
+def _initFileWorker(builder, proteinKeys):
+    vectorizer = StreamVectorizer()
+    proteins = [{"id":protId, "sets":sets, "features":None} for protId, sets in proteinKeys]
+    _fileWorker.update({"builder":builder, "vectorizer":vectorizer, "proteins":proteins, "proteinIndex":ProteinIndex(proteins)})
+
+def _buildFileInWorker(filePath):
+    """
+    Read a single feature file in a worker process. Returns the features of the file as a 
+    matrix over the builder's proteins, the indices of the covered proteins and the output 
+    printed while reading the file.
+    """
+    builder, vectorizer, proteins = _fileWorker["builder"], _fileWorker["vectorizer"], _fileWorker["proteins"]
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        vectorizer.clear()
+        for protein in proteins:
+            protein["features"] = vectorizer.addRow()
+        builder.beginCoverage(proteins)
+        builder.buildForFile(filePath, _fileWorker["proteinIndex"])
+        covered = np.array([i for i in range(len(proteins)) if proteins[i]["id"] in builder.coverage["total"]], dtype=np.int64)
+        matrix, featureNames = vectorizer.getMatrix()
+        return matrix, featureNames, covered, sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+
 class MultiFileFeatureBuilder(FeatureBuilder):
     def __init__(self, inPaths, filePatterns, tag, message, debug=False):
         FeatureBuilder.__init__(self, debug=debug)
@@ -66,31 +170,81 @@ class MultiFileFeatureBuilder(FeatureBuilder):
         self.inPaths = inPaths
         self.filePatterns = filePatterns
         self.message = message
+        self.fileJobs = None # The number of processes for reading the files in parallel
+        self.chunkSize = 100000 # The number of rows per chunk when reading the files with pandas
+        self.sortedInput = False # Whether the rows of the files are sorted by protein id (for a sorted-merge join)
     
     def setDataPath(self, dataPath):
         FeatureBuilder.setDataPath(self, dataPath)
         if dataPath != None:
             self.inPaths = [os.path.join(dataPath, x) for x in self.inPaths]
     
-    def build(self, proteins):
+    def getInputPaths(self):
+        return self.getMatchingPaths(self.inPaths, self.filePatterns)
+    
+    def build(self, proteins, proteinIndex=None):
         print self.message
-        protById = {}
-        for protein in proteins:
-            protById[protein["id"]] = protein
-        assert len(protById) == len(proteins)
+        if proteinIndex == None:
+            proteinIndex = ProteinIndex(proteins)
+        assert len(proteinIndex) == len(proteins)
         self.beginCoverage(proteins)
-        for filePath in self.getMatchingPaths(self.inPaths, self.filePatterns):
-            print "Reading", filePath
-            try:
-                self.buildForFile(filePath, protById)
-            except IOError as e:
-                print e
-                print "Error reading file", filePath
-                if not self.debug:
-                    raise e
+        filePaths = self.getMatchingPaths(self.inPaths, self.filePatterns)
+        if self.fileJobs > 1 and len(filePaths) > 1 and not current_process().daemon:
+            self.buildFilesInParallel(filePaths, proteins)
+        else:
+            for filePath in filePaths:
+                print "Reading", filePath
+                try:
+                    self.buildForFile(filePath, proteinIndex)
+                except IOError as e:
+                    print e
+                    print "Error reading file", filePath
+                    if not self.debug:
+                        raise e
         self.finishCoverage()
     
-    def buildForFile(self, filePath, protById):
+    def buildFilesInParallel(self, filePaths, proteins):
+        print "Reading", len(filePaths), "files using", self.fileJobs, "processes"
+        pool = Pool(min(self.fileJobs, len(filePaths)), _initFileWorker, (self, [(x["id"], x["sets"]) for x in proteins]))
+        try:
+            results = pool.imap(_buildFileInWorker, filePaths, chunksize=1)
+            for filePath in filePaths:
+                print "Reading", filePath
+                try:
+                    matrix, featureNames, covered, output = results.next()
+                except IOError as e:
+                    print e
+                    print "Error reading file", filePath
+                    if not self.debug:
+                        raise e
+                    continue
+                sys.stdout.write(output)
+                for index in covered:
+                    self.addToCoverage(proteins[index])
+                self.addFeatureMatrix(proteins, matrix, featureNames)
+        finally:
+            pool.terminate()
+    
+    def addFeatureMatrix(self, proteins, matrix, featureNames):
+        rows = [x["features"] for x in proteins]
+        vectorizer = rows[0].vectorizer if len(rows) > 0 and isinstance(rows[0], FeatureRow) else None
+        if vectorizer != None and all(isinstance(x, FeatureRow) and x.vectorizer is vectorizer for x in rows):
+            vectorizer.addMatrix(matrix, featureNames, np.array([x.index for x in rows], dtype=np.int32))
+        else:
+            coo = matrix.tocoo()
+            for row, col, value in zip(coo.row, coo.col, coo.data):
+                rows[row][featureNames[col]] = value
+    
+    def readChunks(self, filePath, delimiter, columns=None, skipHeader=False):
+        """
+        Read a gzipped table file with the pandas C parser. All columns are read as strings, 
+        and the file is returned as an iterator over DataFrame chunks.
+        """
+        return pandas.read_csv(filePath, sep=delimiter, compression="gzip", header=None if columns != None else 0, names=columns,
+                               skiprows=1 if skipHeader else None, index_col=False, dtype=str, na_filter=False, 
+                               chunksize=self.chunkSize, engine="c")
+    
+    def buildForFile(self, filePath, proteinIndex):
         raise NotImplementedError()
 
 class KeyValueFeatureBuilder(MultiFileFeatureBuilder):
@@ -98,14 +252,26 @@ class KeyValueFeatureBuilder(MultiFileFeatureBuilder):
         MultiFileFeatureBuilder.__init__(self, inPaths, filePatterns, tag, message, debug=debug)
         self.skipHeader = skipHeader
     
-    def buildForFile(self, filePath, protById):
+    def buildForFile(self, filePath, proteinIndex):
+        if pandas == None:
+            return self.buildForFileByLine(filePath, proteinIndex)
+        for chunk in self.readChunks(filePath, "\t", ["key", "value"], self.skipHeader):
+            for key, value in zip(chunk["key"].values, chunk["value"].values):
+                protein = proteinIndex.get(key)
+                if protein is not None:
+                    self.addToCoverage(protein)
+                    self.setValue(protein, value.strip())
+                elif self.debug:
+                    print "No match for feature key '" + str(key) + "' in", self
+    
+    def buildForFileByLine(self, filePath, proteinIndex):
         with gzip.open(filePath, "rt") as f:
             if self.skipHeader:
                 f.readline() # Skip the headers
             for line in f:
                 #print line.strip().split("\t")
                 key, value = line.strip().split("\t")
-                protein = protById.get(key)
+                protein = proteinIndex.get(key)
                 if protein is not None:
                     self.addToCoverage(protein)
                     self.setValue(protein, value)
@@ -122,19 +288,61 @@ class CSVFeatureBuilder(MultiFileFeatureBuilder):
         self.protColumn = protColumn
         self.delimiter = delimiter
     
-    def buildForFile(self, filePath, protById):
+    def buildForFile(self, filePath, proteinIndex):
+        if pandas == None:
+            return self.buildForFileByRow(filePath, proteinIndex)
+        for chunk in self.readChunks(filePath, self.delimiter, self.columns):
+            # Find the proteins of the rows
+            protIds = chunk[self.protColumn].values
+            if self.sortedInput: # The rows of a protein are consecutive, so the ids are found without sorting
+                starts = np.flatnonzero(np.concatenate(([True], protIds[1:] != protIds[:-1])))
+                inverse = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(protIds))))
+                positions = proteinIndex.merge(protIds[starts])
+            else:
+                uniqueIds, inverse = np.unique(protIds, return_inverse=True)
+                positions = proteinIndex.lookup(uniqueIds)
+            found = positions >= 0
+            for protein in proteinIndex.proteins[positions[found]]:
+                self.addToCoverage(protein)
+            rowFound = found[inverse]
+            if not rowFound.any():
+                continue
+            chunk = chunk[rowFound]
+            features = [x["features"] for x in proteinIndex.proteins[positions[inverse[rowFound]]]]
+            try:
+                self.setChunk(features, chunk, filePath)
+            except ValueError as e:
+                print e
+                print "Error reading chunk from file", filePath
+                if not self.debug:
+                    raise e
+                # Process the failed chunk row by row to skip only the invalid rows
+                for rowFeatures, row in zip(features, chunk.to_dict("records")):
+                    try:
+                        self.setRow(rowFeatures, row, filePath)
+                    except ValueError as e:
+                        print e
+                        print "Error reading row from file", filePath
+    
+    def buildForFileByRow(self, filePath, proteinIndex):
         with gzip.open(filePath, "rt") as f:
             reader = csv.DictReader(f, delimiter=self.delimiter, fieldnames=self.columns)
             currentId = None
             found = False
             features = None
+            cursor = 0
             for row in reader:
                 if row[self.protColumn] != currentId:
                     currentId = row[self.protColumn]
-                    found = currentId in protById
-                    features = protById[currentId]["features"] if found else None
+                    if self.sortedInput:
+                        position, cursor = proteinIndex.seek(currentId, cursor)
+                        protein = proteinIndex.proteins[position] if position >= 0 else None
+                    else:
+                        protein = proteinIndex.get(currentId)
+                    found = protein is not None
+                    features = protein["features"] if found else None
                     if found:
-                        self.addToCoverage(protById[currentId])
+                        self.addToCoverage(protein)
                 if found:
                     try:
                         self.setRow(features, row, filePath)
@@ -149,18 +357,135 @@ class CSVFeatureBuilder(MultiFileFeatureBuilder):
             if key != self.protColumn:
                 features[self.tag + ":" + key] = float(row[key])
     
+    def setChunk(self, features, chunk, filePath):
+        """
+        Set the features for a chunk of rows. Like setRow, but the columns of the rows are
+        given as arrays. features is the list of the feature rows of the chunk's proteins.
+        """
+        for key in chunk.columns:
+            if key != self.protColumn:
+                self.setFeatureValues(features, self.tag + ":" + key, chunk[key].values.astype(float))
+    
 ###############################################################################
 # Feature Builders
 ###############################################################################
 
 class BlastFeatureBuilder(CSVFeatureBuilder):
-    def __init__(self, inPaths, tag="BLAST", debug=False): 
+    """
+    Builds one feature per matched Swissprot protein, with the Hsp_score of the hit as the value.
+    
+    The hits can be pruned with maxEvalue (HSPs with a higher e-value are skipped) and topK (only
+    the K hits with the highest bit score are kept per protein). The aggregate setting defines the
+    value for a hit with multiple HSPs: "last" (the last HSP read), "max" or "mean". A protein can 
+    have hits in several result files of the group (such as the temp_ and the regular directories), 
+    so when pruning the hits of all the files are collected before aggregating them and keeping 
+    the top-K hits, and the files are read in the building process.
+    """
+    cacheKeyExclude = CSVFeatureBuilder.cacheKeyExclude + ("hits",)
+    
+    def __init__(self, inPaths, tag="BLAST", debug=False, topK=None, maxEvalue=None, aggregate="last"): 
         filePatterns = (re.compile("target.[0-9]+.features_tsv\.gz"), re.compile("Swissprot\_sequence\_[0-9]\.features\_tsv\.gz"), re.compile("sequence\_[0-9]+\.fasta\.features\_tsv\.gz"), re.compile("(.*?).features_tsv\.gz"))
         columns = ["Uniprot_ID query","Unknown_A","Unknown_B","Unknown_C","Matched Uniprot_ID","Matched Uniprot_ACC","Hsp_hit-len","Hsp_align-len","Hsp_bit-score","Hsp_score","Hsp_evalue","hsp.query_start","hsp.query_end","Hsp_hit-from","Hsp_hit-to","Hsp_query-frame","Hsp_hit-frame","Hsp_identity","Hsp_positives","Hsp_gaps"]
         CSVFeatureBuilder.__init__(self, inPaths, filePatterns, tag, "Building BLAST features", "Uniprot_ID query", columns, debug=debug)
+        self.setPruning(topK, maxEvalue, aggregate)
+        self.hits = None
+    
+    def setPruning(self, topK, maxEvalue, aggregate):
+        assert aggregate in ("last", "max", "mean"), aggregate
+        assert topK == None or topK > 0, topK
+        self.topK = topK
+        self.maxEvalue = maxEvalue
+        self.aggregate = aggregate
+    
+    def isPruned(self):
+        return self.topK != None or self.aggregate != "last"
+    
+    def build(self, proteins, proteinIndex=None):
+        if not self.isPruned():
+            return CSVFeatureBuilder.build(self, proteins, proteinIndex)
+        fileJobs = self.fileJobs
+        self.fileJobs = None
+        self.hits = {"rows":[], "rowIndex":{}, "ids":[], "idIndex":{}, "hitRows":array("i"), "hitIds":array("i"), "scores":array("d"), "bitScores":array("d")}
+        try:
+            CSVFeatureBuilder.build(self, proteins, proteinIndex)
+            self.setHitFeatures()
+        finally:
+            self.hits = None
+            self.fileJobs = fileJobs
+    
+    def addHit(self, features, hitId, score, bitScore):
+        hits = self.hits
+        rowIndex = hits["rowIndex"].get(id(features))
+        if rowIndex is None:
+            rowIndex = hits["rowIndex"][id(features)] = len(hits["rows"])
+            hits["rows"].append(features)
+        idIndex = hits["idIndex"].get(hitId)
+        if idIndex is None:
+            idIndex = hits["idIndex"][hitId] = len(hits["ids"])
+            hits["ids"].append(hitId)
+        hits["hitRows"].append(rowIndex)
+        hits["hitIds"].append(idIndex)
+        hits["scores"].append(score)
+        hits["bitScores"].append(bitScore)
+    
+    def setHitFeatures(self):
+        """
+        Aggregate the HSPs of the buffered hits, prune each protein to its top-K hits and set the features.
+        """
+        hits = self.hits
+        rows = np.frombuffer(hits["hitRows"], dtype=np.int32)
+        ids = np.frombuffer(hits["hitIds"], dtype=np.int32)
+        scores = np.frombuffer(hits["scores"], dtype=np.float64)
+        bitScores = np.frombuffer(hits["bitScores"], dtype=np.float64)
+        if len(rows) == 0:
+            return
+        # Group the HSPs by protein and hit, keeping the file order within the groups
+        order = np.lexsort((np.arange(len(rows)), ids, rows))
+        rows, ids, scores, bitScores = rows[order], ids[order], scores[order], bitScores[order]
+        starts = np.flatnonzero(np.concatenate(([True], (rows[1:] != rows[:-1]) | (ids[1:] != ids[:-1]))))
+        ends = np.append(starts[1:], len(rows))
+        if self.aggregate == "max":
+            values = np.maximum.reduceat(scores, starts)
+        elif self.aggregate == "mean":
+            values = np.add.reduceat(scores, starts) / (ends - starts)
+        else:
+            values = scores[ends - 1]
+        rows, ids, bitScores = rows[starts], ids[starts], np.maximum.reduceat(bitScores, starts)
+        if self.topK != None:
+            # Rank the hits of each protein by their best bit score, ties in order of the hit ids
+            order = np.lexsort((ids, -bitScores, rows))
+            rows, ids, bitScores, values = rows[order], ids[order], bitScores[order], values[order]
+            rowStarts = np.flatnonzero(np.concatenate(([True], rows[1:] != rows[:-1])))
+            ranks = np.arange(len(rows)) - np.repeat(rowStarts, np.diff(np.append(rowStarts, len(rows))))
+            keep = ranks < self.topK
+            rows, ids, values = rows[keep], ids[keep], values[keep]
+            assert len(rows) == 0 or np.bincount(rows).max() <= self.topK
+        hitIds = np.empty(len(hits["ids"]), dtype=object)
+        hitIds[:] = hits["ids"]
+        features = np.empty(len(hits["rows"]), dtype=object)
+        features[:] = hits["rows"]
+        self.setFeatureValues(features[rows].tolist(), hitIds[ids].tolist(), values, self.tag + ":Hsp_score:")
     
     def setRow(self, features, row, filePath):
-        features[self.tag + ":Hsp_score:" + row["Matched Uniprot_ID"]] = float(row["Hsp_score"])
+        if self.maxEvalue != None and float(row["Hsp_evalue"]) > self.maxEvalue:
+            return
+        if self.hits != None:
+            self.addHit(features, row["Matched Uniprot_ID"], float(row["Hsp_score"]), float(row["Hsp_bit-score"]))
+        else:
+            self.setPrefixedFeature(features, self.tag + ":Hsp_score:", row["Matched Uniprot_ID"], float(row["Hsp_score"]))
+    
+    def setChunk(self, features, chunk, filePath):
+        if self.maxEvalue != None:
+            passed = chunk["Hsp_evalue"].values.astype(float) <= self.maxEvalue
+            chunk = chunk[passed]
+            features = [x for x, y in zip(features, passed) if y]
+        if self.hits != None:
+            for rowFeatures, hitId, score, bitScore in zip(features, chunk["Matched Uniprot_ID"].values, 
+                                                           chunk["Hsp_score"].values.astype(float).tolist(), 
+                                                           chunk["Hsp_bit-score"].values.astype(float).tolist()):
+                self.addHit(rowFeatures, hitId, score, bitScore)
+        else:
+            self.setFeatureValues(features, chunk["Matched Uniprot_ID"].values, chunk["Hsp_score"].values.astype(float), self.tag + ":Hsp_score:")
 
 class TaxonomyFeatureBuilder(KeyValueFeatureBuilder):
     def __init__(self, inPaths, debug=False):
@@ -193,7 +518,10 @@ class NGramFeatureBuilder(CSVFeatureBuilder):
         CSVFeatureBuilder.__init__(self, inPaths, filePatterns, "NGRAM", "Building NGram features", "PROT_ID")
     
     def setRow(self, features, row, filePath):
-        features[self.tag + ":NGRAM_ID=" + row["NGRAM_ID"]] = 1
+        self.setPrefixedFeature(features, self.tag + ":NGRAM_ID=", row["NGRAM_ID"], 1)
+    
+    def setChunk(self, features, chunk, filePath):
+        self.setFeatureValues(features, chunk["NGRAM_ID"].values, 1, self.tag + ":NGRAM_ID=")
     
 class InterProScanFeatureBuilder(CSVFeatureBuilder):
     def __init__(self, inPaths, debug=False):
@@ -219,6 +547,21 @@ class InterProScanFeatureBuilder(CSVFeatureBuilder):
             name += ":motif=" + row["motifNumber"]
         # Add the feature for the protein
         features[name] = value
+    
+    def setChunk(self, features, chunk, filePath):
+        # Choose the identifier and value columns as in setRow
+        for idType in ("GOid", "ac", "db"):
+            if idType in chunk.columns:
+                break
+        for valueType in ("score", "evalue", "bin"):
+            if valueType in chunk.columns:
+                break
+        values = 1.0 if valueType == "bin" else chunk[valueType].values.astype(float)
+        fileTag = os.path.basename(filePath).split(".")[0]
+        names = self.tag + ":" + fileTag + ":" + idType + "=" + chunk[idType].str.replace(":", "_") + ":" + valueType
+        if "motifNumber" in chunk.columns:
+            names = names + ":motif=" + chunk["motifNumber"]
+        self.setFeatureValues(features, names.values, values)
 
 class FunTaxISFeatureBuilder(CSVFeatureBuilder):
     def __init__(self, inPaths):
@@ -226,7 +569,10 @@ class FunTaxISFeatureBuilder(CSVFeatureBuilder):
         CSVFeatureBuilder.__init__(self, inPaths, filePatterns, "FUN", "Building FunTaxIS features", None)
         self.mapFilePatterns = [re.compile("map\_.+\_organism\.tsv\.gz")]
     
-    def buildForFile(self, filePath, protById):
+    def getInputPaths(self):
+        return CSVFeatureBuilder.getInputPaths(self) + self.getMatchingPaths(self.inPaths, self.mapFilePatterns)
+    
+    def buildForFile(self, filePath, proteinIndex):
         if self.mapping == None:
             self.mapping = self.readMapping(self.inPaths, self.mapFilePatterns)
         with gzip.open(filePath, "rt") as f:
@@ -240,9 +586,10 @@ class FunTaxISFeatureBuilder(CSVFeatureBuilder):
                     currentProteins = []
                     if ncbitax_id in self.mapping:
                         for protId in self.mapping[ncbitax_id]:
-                            if protId in protById:
-                                self.addToCoverage(protById[protId])
-                                currentProteins.append(protById[protId])
+                            protein = proteinIndex.get(protId)
+                            if protein is not None:
+                                self.addToCoverage(protein)
+                                currentProteins.append(protein)
                     if len(currentProteins) == 0:
                         currentProteins = None
                 if currentProteins != None:
@@ -283,7 +630,10 @@ class UniprotFeatureBuilder(FeatureBuilder):
         if dataPath != None:
             self.inPath = os.path.join(dataPath, self.inPath)
     
-    def build(self, proteins):
+    def getInputPaths(self):
+        return [self.inPath]
+    
+    def build(self, proteins, proteinIndex=None):
         if self.data == None:
             self.loadSimilar(self.inPath)
         print "Building Uniprot similar.txt features"
@@ -2,6 +2,9 @@ import gzip
 import csv
 import os
 import operator
+import numpy as np
+import scipy.sparse
+from array import array
 from collections import defaultdict
 from sklearn.feature_extraction import DictVectorizer
 from sklearn.preprocessing import MultiLabelBinarizer
@@ -54,6 +57,14 @@ def loadBaseline(inPath, proteins, key="baseline", cutoff=1, limitTerms=None, us
 
 def loadAnnotations(inPath, proteins):
     print "Loading annotations from", inPath
+    if isinstance(proteins, ProteinTable):
+        with gzip.open(inPath, "rt") as f:
+            tsv = csv.reader(f, delimiter='\t')
+            for row in tsv:
+                assert len(row) == 3, row
+                protId, goTerm, evCode = row
+                proteins.addTerm(proteins.index[protId], goTerm, evCode)
+        return proteins.getTermCounts()
     counts = defaultdict(int)
     with gzip.open(inPath, "rt") as f:
         tsv = csv.reader(f, delimiter='\t')
@@ -83,6 +94,8 @@ def loadHPOAnnotations(inPath, proteins):
     print "Loading HPO annotations from", inPath
     counts = defaultdict(int)
     stats = {"missing":set(), "match":set()}
+    isTable = isinstance(proteins, ProteinTable)
+    rows, terms = array("i"), array("i")
     with gzip.open(inPath, "rt") as f:
         tsv = csv.reader(f, delimiter='\t')
         for row in tsv:
@@ -91,12 +104,19 @@ def loadHPOAnnotations(inPath, proteins):
                 stats["missing"].add(protId)
                 continue
             stats["match"].add(protId)
+            if isTable:
+                rows.append(proteins.index[protId])
+                terms.append(proteins.getTermId(termId))
+                continue
             protein = proteins[protId]
             if "terms" not in protein:
                 protein["terms"] = {}
             protein["terms"][termId] = "N/A"
             counts[termId] += 1
     print "Loaded HPO annotations:", {key:len(stats[key]) for key in stats}
+    if isTable:
+        proteins.addTerms(rows, terms, proteins.getEvidenceId("N/A"))
+        return proteins.getTermCounts()
     return counts
 
 def getTopTerms(counts, num=1000):
@@ -139,11 +159,375 @@ def loadOBOTerms(inPath, onlyNames=False, forceNameSpace=None):
     #    terms = {key:terms[key]["name"] for key in terms}
     return terms
 
-def addProtein(proteins, protId, cafaId, sequence, filename, replaceSeq=False, verbose=False, counts=None):
+class SequenceStore(object):
+    """
+    Stores sequences in one contiguous buffer. A sequence is referred to by its index, and
+    is located in the buffer by the offsets array.
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.offsets = array("l", [0])
+    
+    def __len__(self):
+        return len(self.offsets) - 1
+    
+    def add(self, sequence):
+        self.buffer.extend(sequence)
+        self.offsets.append(len(self.buffer))
+        return len(self.offsets) - 2
+    
+    def get(self, index):
+        return str(self.buffer[self.offsets[index]:self.offsets[index + 1]])
+    
+    def getLength(self, index):
+        return self.offsets[index + 1] - self.offsets[index]
+
+def getSequence(protein, sequences=None):
+    """
+    Return the sequence of a protein, stored either directly or as an index into a SequenceStore.
+    """
+    return sequences.get(protein["seq"]) if sequences != None else protein["seq"]
+
+class ProteinView(object):
+    """
+    A dictionary-like view of a single protein in a ProteinTable.
+    """
+    __slots__ = ("table", "row")
+    
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+    
+    def __getitem__(self, key):
+        return self.table.getValue(self.row, key)
+    
+    def __setitem__(self, key, value):
+        self.table.setValue(self.row, key, value)
+    
+    def __delitem__(self, key):
+        self.table.deleteValue(self.row, key)
+    
+    def __contains__(self, key):
+        return self.table.hasValue(self.row, key)
+    
+    def get(self, key, default=None):
+        return self.table.getValue(self.row, key) if self.table.hasValue(self.row, key) else default
+    
+    def keys(self):
+        return [x for x in self.table.getKeys() if self.table.hasValue(self.row, x)]
+    
+    def __repr__(self):
+        return repr({x:self[x] for x in self.keys()})
+
+class TermView(object):
+    """
+    A dictionary-like view of the terms (term -> evidence code) of a single protein in a ProteinTable.
+    """
+    __slots__ = ("table", "row")
+    
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+    
+    def __getitem__(self, term):
+        return self.table.getTerms(self.row)[term]
+    
+    def __setitem__(self, term, evidence):
+        self.table.addTerm(self.row, term, evidence)
+    
+    def __contains__(self, term):
+        return term in self.table.getTerms(self.row)
+    
+    def __len__(self):
+        return len(self.table.getTerms(self.row))
+    
+    def __iter__(self):
+        return iter(self.table.getTerms(self.row))
+    
+    def get(self, term, default=None):
+        return self.table.getTerms(self.row).get(term, default)
+    
+    def keys(self):
+        return self.table.getTerms(self.row).keys()
+    
+    def items(self):
+        return self.table.getTerms(self.row).items()
+
+class ProteinTable(object):
+    """
+    A table of proteins with array-backed columns, replacing a dictionary of protein dictionaries.
+    The rows are found with an integer id index. The split, sets, file and fold values are stored
+    as small integer codes, the sequence as an index into a SequenceStore and the terms as a sparse
+    protein-by-term matrix with an evidence code array. Other values (e.g. features or predictions)
+    are stored in a dictionary of rows per key.
+    
+    The table can be used like a dictionary of protein dictionaries, proteins[protId] returning a 
+    ProteinView. List values of the coded columns are returned as tuples, so that they cannot be 
+    modified in place and a modified value must be assigned back (e.g. protein["file"] += (filename,)).
+    """
+    CODED = ("split", "sets", "file", "fold")
+    
+    def __init__(self):
+        self.ids = []
+        self.index = {}
+        self.seq = array("l")
+        self.codes = {key:array("h") for key in self.CODED}
+        self.codeValues = {key:[] for key in self.CODED}
+        self.codeIndex = {key:{} for key in self.CODED}
+        self.cafaIds = {}
+        self.columns = {}
+        # Terms
+        self.termNames = []
+        self.termIds = {}
+        self.evidenceNames = []
+        self.evidenceIds = {}
+        self.termRows = array("i")
+        self.termCols = array("i")
+        self.termEvidence = array("h")
+        self.annotated = bytearray()
+        self.termMatrix = None
+    
+    ###########################################################################
+    # Dictionary Interface
+    ###########################################################################
+    
+    def __len__(self):
+        return len(self.index)
+    
+    def __contains__(self, protId):
+        return protId in self.index
+    
+    def __iter__(self):
+        return iter(self.keys())
+    
+    def __getitem__(self, protId):
+        return ProteinView(self, self.index[protId])
+    
+    def __setitem__(self, protId, protein):
+        if protId in self.index:
+            del self[protId]
+        row = self.addRow(protId)
+        for key in protein:
+            if key != "id":
+                self.setValue(row, key, protein[key])
+    
+    def __delitem__(self, protId):
+        row = self.index.pop(protId)
+        for key in self.columns:
+            self.columns[key].pop(row, None)
+        self.cafaIds.pop(row, None)
+    
+    def get(self, protId, default=None):
+        return self[protId] if protId in self.index else default
+    
+    def keys(self):
+        return self.index.keys()
+    
+    def values(self):
+        return [ProteinView(self, row) for row in self.index.itervalues()]
+    
+    def items(self):
+        return [(protId, ProteinView(self, row)) for protId, row in self.index.iteritems()]
+    
+    ###########################################################################
+    # Columns
+    ###########################################################################
+    
+    def addRow(self, protId):
+        row = len(self.ids)
+        self.ids.append(protId)
+        self.index[protId] = row
+        self.seq.append(-1)
+        self.annotated.append(0)
+        for key in self.CODED:
+            self.codes[key].append(-1)
+        return row
+    
+    def getKeys(self):
+        return ["id", "seq", "cafa_ids", "terms"] + list(self.CODED) + sorted(self.columns.keys())
+    
+    def getCode(self, key, value):
+        if isinstance(value, list):
+            value = tuple(value)
+        code = self.codeIndex[key].get(value)
+        if code is None:
+            code = self.codeIndex[key][value] = len(self.codeValues[key])
+            self.codeValues[key].append(value)
+        return code
+    
+    def getValue(self, row, key):
+        if key == "id":
+            return self.ids[row]
+        elif key == "terms":
+            return TermView(self, row)
+        elif key == "cafa_ids":
+            return self.cafaIds.get(row, [])
+        elif key == "seq" and self.seq[row] >= 0:
+            return self.seq[row]
+        elif key in self.codes:
+            code = self.codes[key][row]
+            if code < 0:
+                raise KeyError(key)
+            return self.codeValues[key][code]
+        return self.columns[key][row]
+    
+    def setValue(self, row, key, value):
+        if key == "id":
+            assert value == self.ids[row]
+        elif key == "terms":
+            self.setTerms(row, value)
+        elif key == "cafa_ids":
+            if len(value) > 0:
+                self.cafaIds[row] = value
+            else:
+                self.cafaIds.pop(row, None)
+        elif key == "seq" and isinstance(value, (int, long)):
+            self.seq[row] = value
+        elif key in self.codes:
+            self.codes[key][row] = self.getCode(key, value)
+        else:
+            if key not in self.columns:
+                self.columns[key] = {}
+            self.columns[key][row] = value
+    
+    def deleteValue(self, row, key):
+        if key in self.codes and self.codes[key][row] >= 0:
+            self.codes[key][row] = -1
+        elif key == "seq" and self.seq[row] >= 0:
+            self.seq[row] = -1
+        elif key in self.columns and row in self.columns[key]:
+            del self.columns[key][row]
+        else:
+            raise KeyError(key)
+    
+    def hasValue(self, row, key):
+        if key in ("id", "terms", "cafa_ids"):
+            return True
+        elif key == "seq" and self.seq[row] >= 0:
+            return True
+        elif key in self.codes:
+            return self.codes[key][row] >= 0
+        return key in self.columns and row in self.columns[key]
+    
+    ###########################################################################
+    # Terms
+    ###########################################################################
+    
+    def getTermId(self, term):
+        col = self.termIds.get(term)
+        if col is None:
+            col = self.termIds[term] = len(self.termNames)
+            self.termNames.append(term)
+        return col
+    
+    def getEvidenceId(self, evidence):
+        code = self.evidenceIds.get(evidence)
+        if code is None:
+            code = self.evidenceIds[evidence] = len(self.evidenceNames)
+            self.evidenceNames.append(evidence)
+        return code
+    
+    def addTerm(self, row, term, evidence):
+        self.termRows.append(row)
+        self.termCols.append(self.getTermId(term))
+        self.termEvidence.append(self.getEvidenceId(evidence))
+        self.annotated[row] = 1
+        self.termMatrix = None
+    
+    def addTerms(self, rows, terms, evidence):
+        """
+        Add the annotations for the table rows rows[i] with the term ids (see getTermId) terms[i] and
+        the evidence code ids (see getEvidenceId) evidence[i]. evidence can also be a single id.
+        """
+        rows = np.asarray(rows, dtype=np.int32)
+        if np.isscalar(evidence):
+            evidence = np.repeat(np.int16(evidence), len(rows))
+        self.termRows.fromstring(rows.tostring())
+        self.termCols.fromstring(np.asarray(terms, dtype=np.int32).tostring())
+        self.termEvidence.fromstring(np.asarray(evidence, dtype=np.int16).tostring())
+        for row in np.unique(rows).tolist():
+            self.annotated[row] = 1
+        self.termMatrix = None
+    
+    def setTerms(self, row, terms):
+        if self.annotated[row]: # Remove the existing terms of the protein
+            keep = np.frombuffer(self.termRows, dtype=np.int32) != row
+            for name in ("termRows", "termCols", "termEvidence"):
+                values = getattr(self, name)
+                setattr(self, name, array(values.typecode, np.frombuffer(values, dtype=values.typecode)[keep].tostring()))
+            self.annotated[row] = 0
+            self.termMatrix = None
+        for term in sorted(terms.keys()):
+            self.addTerm(row, term, terms[term])
+    
+    def getTermMatrix(self):
+        """
+        Return the protein-by-term annotation matrix (with a row for every row of the table, including 
+        the removed ones) and the evidence codes of the matrix entries.
+        """
+        if self.termMatrix == None:
+            rows = np.frombuffer(self.termRows, dtype=np.int32)
+            cols = np.frombuffer(self.termCols, dtype=np.int32)
+            evidence = np.frombuffer(self.termEvidence, dtype=np.int16)
+            # Sort by row and column, and for repeated terms keep the evidence code that was set last
+            sequence = np.arange(len(rows))
+            sequence = sequence[np.lexsort((sequence, cols, rows))]
+            last = np.ones(len(sequence), dtype=bool)
+            last[:-1] = (rows[sequence[1:]] != rows[sequence[:-1]]) | (cols[sequence[1:]] != cols[sequence[:-1]])
+            sequence = sequence[last]
+            indptr = np.zeros(len(self.ids) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(rows[sequence], minlength=len(self.ids)), out=indptr[1:])
+            matrix = scipy.sparse.csr_matrix((np.ones(len(sequence), dtype=np.int8), cols[sequence], indptr), shape=(len(self.ids), len(self.termNames)))
+            self.termMatrix = (matrix, evidence[sequence])
+        return self.termMatrix
+    
+    def getRows(self, protIds=None):
+        """
+        Return the table rows of the protIds, or all the (not removed) rows in order.
+        """
+        if protIds == None:
+            return np.array(sorted(self.index.itervalues()), dtype=np.int64)
+        return np.array([self.index[x] for x in protIds], dtype=np.int64)
+    
+    def getTermCounts(self):
+        matrix = self.getTermMatrix()[0][self.getRows()]
+        counts = np.asarray(matrix.sum(axis=0)).ravel()
+        return {self.termNames[i]:int(counts[i]) for i in np.flatnonzero(counts)}
+    
+    def getTopTerms(self, num=1000):
+        """
+        Return the num most common terms as (term, count) pairs. Terms with the same count
+        are in alphabetical order.
+        """
+        matrix = self.getTermMatrix()[0][self.getRows()]
+        counts = np.asarray(matrix.sum(axis=0)).ravel()
+        byName = np.array(sorted(range(len(self.termNames)), key=self.termNames.__getitem__), dtype=np.int64)
+        order = byName[np.argsort(-counts[byName], kind="mergesort")]
+        order = order[counts[order] > 0][:num]
+        return [(self.termNames[i], int(counts[i])) for i in order]
+    
+    def getLabels(self, protIds, limitTerms=None):
+        """
+        Return the protein-by-term label matrix for the protIds and the names of its columns. The 
+        columns are the terms (in limitTerms) annotated for at least one of the proteins, in sorted
+        order, as with MultiLabelBinarizer.
+        """
+        matrix = self.getTermMatrix()[0][self.getRows(protIds)]
+        counts = np.asarray(matrix.sum(axis=0)).ravel()
+        cols = [i for i in np.flatnonzero(counts) if limitTerms == None or self.termNames[i] in limitTerms]
+        cols = sorted(cols, key=self.termNames.__getitem__)
+        return matrix[:, cols].tocsr(), [self.termNames[i] for i in cols]
+    
+    def getTerms(self, row):
+        matrix, evidence = self.getTermMatrix()
+        begin, end = matrix.indptr[row], matrix.indptr[row + 1]
+        return {self.termNames[col]:self.evidenceNames[code] for col, code in zip(matrix.indices[begin:end], evidence[begin:end])}
+
+def addProtein(proteins, protId, cafaId, sequence, filename, replaceSeq=False, verbose=False, counts=None, sequences=None):
     assert len(sequence) > 0
     if protId not in proteins:
         proteins[protId] = {}
-        proteins[protId]["seq"] = sequence
+        proteins[protId]["seq"] = sequences.add(sequence) if sequences != None else sequence
         proteins[protId]["id"] = protId
         proteins[protId]["cafa_ids"] = [cafaId] if cafaId else []
         proteins[protId]["file"] = [filename]
@@ -151,15 +535,15 @@ def addProtein(proteins, protId, cafaId, sequence, filename, replaceSeq=False, v
         counts["unique"] += 1
     else:
         counts["multiple"] += 1
-        if proteins[protId]["seq"] != sequence:
+        if getSequence(proteins[protId], sequences) != sequence:
             if verbose:
                 print "WARNING, sequence mismatch for", protId, cafaId, ":", (proteins[protId], (protId, cafaId, sequence, filename))
             counts["mismatch"] += 1
             counts["mismatches"].append(protId)
             if replaceSeq:
-                proteins[protId]["seq"] = sequence
+                proteins[protId]["seq"] = sequences.add(sequence) if sequences != None else sequence
         assert proteins[protId]["id"] == protId, (proteins[protId], (protId, cafaId, sequence, filename))
-        proteins[protId]["file"] += [filename]
+        proteins[protId]["file"] += (filename,)
         if cafaId != None:
             if len(proteins[protId]["cafa_ids"]) > 0:
                 if verbose:
@@ -171,7 +555,11 @@ def addProtein(proteins, protId, cafaId, sequence, filename, replaceSeq=False, v
                 proteins[protId]["cafa_ids"] += [cafaId]
     assert "id" in proteins[protId], (protId, cafaId, proteins[protId])
          
-def loadFASTA(inPath, proteins, cafaHeader=False):
+def loadFASTA(inPath, proteins, cafaHeader=False, sequences=None):
+    """
+    Load the proteins of a FASTA file. If sequences is a SequenceStore, the sequences are 
+    stored in it and the "seq" of a protein is the index of its sequence in the store.
+    """
     print "Loading sequences from", inPath
     filename = os.path.basename(inPath)
     counts = defaultdict(int)
@@ -180,23 +568,23 @@ def loadFASTA(inPath, proteins, cafaHeader=False):
     with openAny(inPath, "rt") as f:
         protId = None
         cafaId = None
-        sequence = ""
+        lines = []
         for line in f:
             if line.startswith(">"):
                 # Add already read protein
                 if protId != None:
-                    addProtein(proteins, protId, cafaId, sequence, filename, counts=counts)
+                    addProtein(proteins, protId, cafaId, "".join(lines), filename, counts=counts, sequences=sequences)
                 protId = None
                 cafaId = None
-                sequence = ""
+                lines = []
                 # Begin new protein
                 protId = line[1:].strip()
                 if cafaHeader:
                     cafaId, protId = protId.split()
             else:
-                sequence += line.strip()
+                lines.append(line.strip())
         if protId != None:
-            addProtein(proteins, protId, cafaId, sequence, filename, counts=counts)               
+            addProtein(proteins, protId, cafaId, "".join(lines), filename, counts=counts, sequences=sequences)
             #print seq.id, seq.seq
     print dict(counts)
 
@@ -290,7 +678,342 @@ def loadIdNames(inPath):
     print "Loaded", len(idNames), "id names"
     return idNames
     
+class ProteinIndex(object):
+    """
+    Maps protein ids to positions in the list of proteins sorted by id. The index is built once
+    and shared by the feature builders. Ids can be looked up one at a time (as with a dictionary),
+    as an array of hash lookups (lookup) or, for ids in sorted order, by merging them with the
+    sorted id array (merge and seek).
+    """
+    def __init__(self, proteins):
+        self.proteins = np.empty(len(proteins), dtype=object)
+        self.proteins[:] = sorted(proteins, key=lambda x: x["id"])
+        self.ids = np.empty(len(proteins), dtype=object)
+        self.ids[:] = [x["id"] for x in self.proteins]
+        self.positions = {self.ids[i]:i for i in range(len(self.ids))}
+        assert len(self.positions) == len(self.ids)
+    
+    def __len__(self):
+        return len(self.ids)
+    
+    def __contains__(self, protId):
+        return protId in self.positions
+    
+    def __getitem__(self, protId):
+        return self.proteins[self.positions[protId]]
+    
+    def get(self, protId, default=None):
+        position = self.positions.get(protId)
+        return self.proteins[position] if position is not None else default
+    
+    def lookup(self, protIds):
+        """
+        Return the positions of the protIds, or -1 for ids not in the index.
+        """
+        return np.array([self.positions.get(x, -1) for x in protIds], dtype=np.int64)
+    
+    def merge(self, protIds):
+        """
+        Return the positions of the sorted protIds, or -1 for ids not in the index.
+        """
+        if len(self.ids) == 0:
+            return -np.ones(len(protIds), dtype=np.int64)
+        positions = np.searchsorted(self.ids, protIds)
+        inRange = positions < len(self.ids)
+        positions[~inRange] = -1
+        positions[inRange & (self.ids[np.minimum(positions, len(self.ids) - 1)] != protIds)] = -1
+        return positions
+    
+    def seek(self, protId, start):
+        """
+        Find protId by advancing from the position start. For ids in sorted order the lookups are 
+        a linear merge. Returns the position of the protein (or -1) and the start for the next id.
+        """
+        ids = self.ids
+        if start > 0 and ids[start - 1] >= protId: # Not in sorted order, or a repeated id
+            return self.positions.get(protId, -1), start
+        while start < len(ids) and ids[start] < protId:
+            start += 1
+        if start < len(ids) and ids[start] == protId:
+            return start, start + 1
+        return -1, start
+
+class FeatureRow(object):
+    """
+    The feature "dictionary" of a single protein. Assigned features are written directly
+    into the buffers of the StreamVectorizer, so no per-protein dictionaries are kept.
+    """
+    __slots__ = ("vectorizer", "index")
+    
+    def __init__(self, vectorizer, index):
+        self.vectorizer = vectorizer
+        self.index = index
+    
+    def __setitem__(self, name, value):
+        self.vectorizer.setFeature(self.index, name, value)
+    
+    def setPrefixed(self, prefix, key, value):
+        self.vectorizer.setPrefixedFeature(self.index, prefix, key, value)
+
+class StreamVectorizer():
+    """
+    Builds the feature matrix incrementally. Feature ids are assigned in the order the 
+    feature names are first seen, and each assigned value is appended as a (row, column, value) 
+    triple. When building is finished the ids are renumbered in sorted name order (like with
+    DictVectorizer) and the triples are converted into a CSR matrix.
+    
+    Features named by a shared prefix and a varying key (e.g. "BLAST:Hsp_score:" + hit id) can be
+    interned per prefix, so that the full name strings are built only once, in getMatrix.
+    """
+    def __init__(self):
+        self.clear()
+    
+    def clear(self):
+        self.vocabulary = {}
+        self.prefixed = {}
+        self.names = []
+        self.numRows = 0
+        self.rows = array("i")
+        self.cols = array("i")
+        self.data = array("d")
+    
+    def addRow(self):
+        row = FeatureRow(self, self.numRows)
+        self.numRows += 1
+        return row
+    
+    def getId(self, name):
+        col = self.vocabulary.get(name)
+        if col is None:
+            col = len(self.names)
+            self.vocabulary[name] = col
+            self.names.append(name)
+        return col
+    
+    def getPrefixedId(self, prefix, key):
+        vocabulary = self.prefixed.get(prefix)
+        if vocabulary is None:
+            vocabulary = self.prefixed[prefix] = {}
+        col = vocabulary.get(key)
+        if col is None:
+            col = len(self.names)
+            vocabulary[key] = col
+            self.names.append((prefix, key))
+        return col
+    
+    def getName(self, col):
+        name = self.names[col]
+        return name if isinstance(name, basestring) else name[0] + name[1]
+    
+    def setFeature(self, rowIndex, name, value):
+        self.rows.append(rowIndex)
+        self.cols.append(self.getId(name))
+        self.data.append(value)
+    
+    def setPrefixedFeature(self, rowIndex, prefix, key, value):
+        self.rows.append(rowIndex)
+        self.cols.append(self.getPrefixedId(prefix, key))
+        self.data.append(value)
+    
+    def addValues(self, rows, names, values, prefix=None):
+        """
+        Set the feature names[i] with the value values[i] for the row rows[i]. names can
+        also be a single feature name used for all rows. If prefix is defined, the names
+        are keys interned under that prefix, and the feature names are prefix + names[i].
+        """
+        rows = np.asarray(rows, dtype=np.int32)
+        if prefix != None:
+            getId = lambda key: self.getPrefixedId(prefix, key)
+        else:
+            getId = self.getId
+        if isinstance(names, basestring):
+            cols = np.empty(len(rows), dtype=np.int32)
+            cols.fill(getId(names))
+        else:
+            cols = np.array([getId(name) for name in names], dtype=np.int32)
+        self.rows.fromstring(rows.tostring())
+        self.cols.fromstring(cols.tostring())
+        self.data.fromstring(np.asarray(values, dtype=np.float64).tostring())
+    
+    def addMatrix(self, matrix, names, rows=None):
+        """
+        Add the values of a feature matrix built for the same rows, e.g. in another process. The
+        values are set in row order, as if they had been set after the already existing values.
+        If defined, rows is an array mapping the matrix rows to the rows of this vectorizer.
+        """
+        if rows is None:
+            assert matrix.shape == (self.numRows, len(names)), (matrix.shape, self.numRows, len(names))
+        coo = scipy.sparse.coo_matrix(matrix)
+        ids = np.array([self.getId(name) for name in names], dtype=np.int32)
+        self.rows.fromstring((coo.row if rows is None else rows[coo.row]).astype(np.int32).tostring())
+        self.cols.fromstring(ids[coo.col].tostring())
+        self.data.fromstring(coo.data.astype(np.float64).tostring())
+    
+    def getMatrix(self):
+        print "Building the feature matrix from", len(self.data), "values with", len(self.names), "unique features"
+        names = [self.getName(i) for i in range(len(self.names))]
+        order = sorted(range(len(names)), key=names.__getitem__)
+        # The same name can have been assigned both directly and through a prefix, so
+        # equal names are merged into a single column
+        newIds = np.empty(len(order), dtype=np.int32)
+        featureNames = []
+        for i in order:
+            if len(featureNames) == 0 or featureNames[-1] != names[i]:
+                featureNames.append(names[i])
+            newIds[i] = len(featureNames) - 1
+        rows = np.frombuffer(self.rows, dtype=np.int32)
+        cols = newIds[np.frombuffer(self.cols, dtype=np.int32)]
+        data = np.frombuffer(self.data, dtype=np.float64)
+        # Sort by row and column, and for repeated features keep the value that was set last
+        sequence = np.arange(len(data))
+        sequence = sequence[np.lexsort((sequence, cols, rows))]
+        last = np.ones(len(sequence), dtype=bool)
+        last[:-1] = (rows[sequence[1:]] != rows[sequence[:-1]]) | (cols[sequence[1:]] != cols[sequence[:-1]])
+        sequence = sequence[last]
+        indptr = np.zeros(self.numRows + 1, dtype=np.int32 if len(sequence) < np.iinfo(np.int32).max else np.int64)
+        np.cumsum(np.bincount(rows[sequence], minlength=self.numRows), out=indptr[1:])
+        matrix = scipy.sparse.csr_matrix((data[sequence], cols[sequence], indptr), shape=(self.numRows, len(featureNames)))
+        return matrix, featureNames
+
+def saveFeatureCache(outPath, matrix, featureNames, covered):
+    print "Saving cached features to", outPath
+    tempPath = outPath + ".tmp"
+    with open(tempPath, "wb") as f:
+        np.savez(f, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr, shape=np.array(matrix.shape),
+                 feature_names=np.array(featureNames, dtype=np.string_), covered=covered)
+    os.rename(tempPath, outPath)
+
+def loadFeatureCache(inPath):
+    print "Loading cached features from", inPath
+    cache = np.load(inPath)
+    matrix = scipy.sparse.csr_matrix((cache["data"], cache["indices"], cache["indptr"]), shape=tuple(cache["shape"]))
+    featureNames = cache["feature_names"].tolist()
+    covered = cache["covered"]
+    cache.close()
+    return matrix, featureNames, covered
+
+def remapColumns(matrix, names, targetNames):
+    targetIndex = dict((name, i) for i, name in enumerate(targetNames))
+    mapping = np.array([targetIndex.get(name, -1) for name in names], dtype=np.int64)
+    coo = scipy.sparse.coo_matrix(matrix)
+    keep = mapping[coo.col] >= 0
+    remapped = scipy.sparse.csr_matrix((coo.data[keep], (coo.row[keep], mapping[coo.col[keep]])), shape=(matrix.shape[0], len(targetNames)), dtype=matrix.dtype)
+    print "Remapped", len(names), "columns to", len(targetNames), "existing ids,", int((mapping < 0).sum()), "columns not in the existing ids"
+    return remapped.toarray() if isinstance(matrix, np.ndarray) else remapped
+
+def remapExamples(examples, idPath):
+    labelIdPath = os.path.join(idPath, "labels.tsv")
+    print "Remapping labels with existing ids from", labelIdPath
+    labelNames = loadIdNames(labelIdPath)
+    labelNames = [labelNames[x] for x in sorted(labelNames.keys())]
+    examples["labels"] = remapColumns(examples["labels"], examples["label_names"], labelNames)
+    examples["label_names"] = labelNames
+    featureIdPath = os.path.join(idPath, "features.tsv.gz")
+    print "Remapping features with existing ids from", featureIdPath
+    featureNames = loadIdNames(featureIdPath)
+    featureNames = [featureNames[x] for x in sorted(featureNames.keys())]
+    examples["features"] = remapColumns(examples["features"], examples["feature_names"], featureNames)
+    examples["feature_names"] = featureNames
+
+def saveExampleStore(examples, outPath):
+    """
+    Save vectorized examples as a single uncompressed npz file. The feature and label 
+    matrices are stored as CSR component arrays and the id, set and name lists as string 
+    arrays, so the examples can be loaded without parsing JSON or re-vectorizing.
+    """
+    assert outPath.endswith(".npz"), outPath
+    print "Saving binary examples to", outPath
+    features = scipy.sparse.csr_matrix(examples["features"])
+    labels = scipy.sparse.csr_matrix(examples["labels"], dtype=np.int8)
+    np.savez(outPath,
+             feature_data=features.data, feature_indices=features.indices, feature_indptr=features.indptr, feature_shape=np.array(features.shape),
+             label_data=labels.data, label_indices=labels.indices, label_indptr=labels.indptr, label_shape=np.array(labels.shape),
+             feature_names=np.array(examples["feature_names"], dtype=np.string_), 
+             label_names=np.array(examples["label_names"], dtype=np.string_),
+             ids=np.array(examples["ids"], dtype=np.string_),
+             cafa_ids=np.array([",".join(x) for x in examples["cafa_ids"]], dtype=np.string_),
+             sets=np.array([",".join(x) for x in examples["sets"]], dtype=np.string_))
+    print "Saved", features.shape[0], "examples with", features.shape[1], "features and", labels.shape[1], "labels"
+
+def loadExampleStore(inPath, sparseLabels=False):
+    print "Loading binary examples from", inPath
+    store = np.load(inPath)
+    examples = {}
+    examples["features"] = scipy.sparse.csr_matrix((store["feature_data"], store["feature_indices"], store["feature_indptr"]), shape=tuple(store["feature_shape"]))
+    labels = scipy.sparse.csr_matrix((store["label_data"], store["label_indices"], store["label_indptr"]), shape=tuple(store["label_shape"]))
+    examples["labels"] = labels if sparseLabels else labels.toarray()
+    examples["feature_names"] = store["feature_names"].tolist()
+    examples["label_names"] = store["label_names"].tolist()
+    examples["ids"] = store["ids"].tolist()
+    examples["cafa_ids"] = [x.split(",") if x != "" else [] for x in store["cafa_ids"].tolist()]
+    examples["sets"] = [x.split(",") if x != "" else [] for x in store["sets"].tolist()]
+    indexExamples(examples)
+    labelSizes = np.asarray(labels.sum(axis=0)).ravel()
+    examples["label_size"] = {name:int(size) for name, size in zip(examples["label_names"], labelSizes)}
+    store.close()
+    print "Loaded", examples["features"].shape[0], "examples with", len(examples["feature_names"]), "features and", len(examples["label_names"]), "labels"
+    return examples
+
+def toObjectArray(values):
+    array = np.empty(len(values), dtype=object)
+    for i in range(len(values)):
+        array[i] = values[i]
+    return array
+
+def getSetMasks(sets):
+    """
+    Return a boolean mask over the examples for each set name in the sets lists.
+    """
+    masks = {}
+    for i in range(len(sets)):
+        for setName in sets[i]:
+            if setName not in masks:
+                masks[setName] = np.zeros(len(sets), dtype=bool)
+            masks[setName][i] = True
+    return masks
+
+def indexExamples(examples):
+    """
+    Precompute the per-set example masks and store the ids and cafa_ids as object arrays, so
+    that subsets of the examples can be selected with index arrays.
+    """
+    examples["set_masks"] = getSetMasks(examples["sets"])
+    for key in ("ids", "cafa_ids"):
+        if key in examples and not isinstance(examples[key], np.ndarray):
+            examples[key] = toObjectArray(examples[key])
+
+def getSubsetIndices(examples, setNames):
+    """
+    Return the indices of the examples belonging to any of the setNames.
+    """
+    if "set_masks" not in examples:
+        indexExamples(examples)
+    mask = np.zeros(len(examples["sets"]), dtype=bool)
+    for setName in setNames:
+        if setName in examples["set_masks"]:
+            mask |= examples["set_masks"][setName]
+    return np.flatnonzero(mask)
+
+def isVectorized(examples):
+    return scipy.sparse.issparse(examples.get("features")) and not isinstance(examples["labels"], list)
+
 def vectorizeExamples(examples, featureGroups=None, sparseLabels=False, idPath=None):
+    if isVectorized(examples):
+        print "Examples are already vectorized"
+        if idPath != None:
+            remapExamples(examples, idPath)
+        indexExamples(examples)
+        return
+    if scipy.sparse.issparse(examples.get("features")):
+        print "Vectorizing labels for examples with a feature matrix"
+        mlb = MultiLabelBinarizer(sparse_output=sparseLabels)
+        examples["labels"] = mlb.fit_transform(examples["labels"])
+        examples["label_names"] = mlb.classes_
+        print "Vectorized", examples["labels"].shape[0], "examples with", len(examples["feature_names"]), "unique features and", len(examples["label_names"]), "unique labels"
+        if idPath != None:
+            remapExamples(examples, idPath)
+        indexExamples(examples)
+        return
     print "Vectorizing examples"
     mlb = MultiLabelBinarizer(sparse_output=sparseLabels)
     if "predictions" in examples and examples["predictions"] != None:
@@ -339,3 +1062,4 @@ def vectorizeExamples(examples, featureGroups=None, sparseLabels=False, idPath=N
         print "Selected features", examples["features"].shape[1]
         #examples["features"] = SelectKBest(chi2, k=1000).fit_transform(examples["features"], examples["labels"])
     print "Vectorized", examples["labels"].shape[0], "examples with", len(examples["feature_names"]), "unique features and", len(examples["label_names"]), "unique labels", ("(sparse)" if sparseLabels else "")
+    indexExamples(examples)
@@ -0,0 +1,316 @@
+import os
+import re
+import csv
+import hashlib
+import numpy as np
+import scipy.sparse
+from array import array
+from loading import openAny
+
+TERM_ID = re.compile(r"^[A-Za-z]+:[0-9]+$") # An ontology term id such as GO:0008150 or HP:0000118
+IC_CACHE_VERSION = 2 # Increment when the calculation changes so that old cached results are not used
+
+def loadTermPairs(inPath):
+    """
+    Load the (parent, child) term pairs of an ontology DAG. The pairs are read from the is_a
+    tags of an OBO file, or from a tab-separated file (such as parent_term2term.txt.gz) with
+    the parent term in the first column and the child term in the second.
+    """
+    print "Loading ontology term pairs from", inPath
+    pairs = []
+    with openAny(inPath, "rt") as f:
+        if inPath.endswith(".obo") or inPath.endswith(".obo.gz"):
+            termId = None
+            for line in f:
+                if line.startswith("["):
+                    termId = None
+                elif line.startswith("id:"):
+                    termId = line.split(":", 1)[1].strip()
+                elif line.startswith("is_a:") and termId != None:
+                    pairs.append((line.split(":", 1)[1].split("!")[0].strip(), termId))
+        else:
+            fileTerms = set()
+            for row in csv.reader(f, delimiter='\t'):
+                if len(row) >= 2 and row[0] != row[1]:
+                    fileTerms.update([x for x in row[:2] if TERM_ID.match(x)])
+                    if TERM_ID.match(row[0]) and TERM_ID.match(row[1]):
+                        pairs.append((row[0], row[1]))
+            # Rows without two term ids (such as the header line) are skipped
+            pairTerms = set([x for pair in pairs for x in pair])
+            if len(pairTerms) != len(fileTerms):
+                raise Exception("Loaded " + str(len(pairTerms)) + " terms from the pairs but the file contains " + str(len(fileTerms)) + " term ids")
+    print "Loaded", len(pairs), "term pairs"
+    return pairs
+
+def loadAnnotationPairs(inPath, annotationFormat="GO"):
+    """
+    Load the annotations of a propagated annotation file in the GO (protein, term, evidence) 
+    or HPO (term, protein) format. Returns the protein row of each annotation as an array and
+    the annotated terms as a list of interned names.
+    """
+    print "Loading annotation pairs from", inPath
+    protIndex = {}
+    names = {}
+    rows = array("i")
+    terms = []
+    with openAny(inPath, "rt") as f:
+        for row in csv.reader(f, delimiter='\t'):
+            protId, term = (row[1], row[0]) if annotationFormat == "HPO" else (row[0], row[1])
+            rows.append(protIndex.setdefault(protId, len(protIndex)))
+            terms.append(names.setdefault(term, term))
+    return np.frombuffer(rows, dtype=np.int32), terms
+
+class InformationContent:
+    """
+    The information content of the ontology terms, as an array keyed by the term index.
+    """
+    def __init__(self, termNames, values):
+        self.termNames = termNames
+        self.values = values
+        self.index = dict((termNames[i], i) for i in xrange(len(termNames)))
+
+    def __len__(self):
+        return len(self.termNames)
+
+    def get(self, term, default=0.0):
+        index = self.index.get(term)
+        return self.values[index] if index != None else default
+
+    def getArray(self, terms, default=0.0):
+        """
+        The information content of the terms as an array, e.g. for the label columns of the examples.
+        """
+        indices = np.array([self.index.get(x, -1) for x in terms], dtype=np.int64)
+        values = np.full(len(indices), default, dtype=np.float64)
+        values[indices >= 0] = self.values[indices[indices >= 0]]
+        return values
+
+def calculateIC(annotationRows, annotationTerms, termPairs):
+    """
+    Calculate the information content ic(f) = -log2 P(f | Pa(f)) of each term f as in CAFA.
+    The annotations must be propagated, so P(f | Pa(f)) is the number of proteins annotated
+    with f divided by the number of proteins annotated with all the parents of f. For root
+    terms the parent count is the number of annotated proteins.
+    """
+    termNames = sorted(set(annotationTerms).union([x for pair in termPairs for x in pair]))
+    termIndex = dict((termNames[i], i) for i in xrange(len(termNames)))
+    numProteins = int(annotationRows.max()) + 1 if len(annotationRows) > 0 else 0
+    cols = np.array([termIndex[x] for x in annotationTerms], dtype=np.int32)
+    annotations = scipy.sparse.csr_matrix((np.ones(len(cols), dtype=np.int32), (annotationRows, cols)), shape=(numProteins, len(termNames)))
+    annotations.data[:] = 1 # Remove duplicate annotations
+    parents = np.array([termIndex[x[0]] for x in termPairs], dtype=np.int64)
+    children = np.array([termIndex[x[1]] for x in termPairs], dtype=np.int64)
+    dag = scipy.sparse.csr_matrix((np.ones(len(parents), dtype=np.int32), (parents, children)), shape=(len(termNames), len(termNames)))
+    dag.data[:] = 1
+    numParents = np.asarray(dag.sum(axis=0)).ravel()
+    # The number of annotated parents of each term for each protein
+    parentCounts = annotations.dot(dag).tocsr()
+    hasAllParents = parentCounts.data == numParents[parentCounts.indices]
+    parentTotals = np.bincount(parentCounts.indices[hasAllParents], minlength=len(termNames)).astype(np.float64)
+    parentTotals[numParents == 0] = numProteins
+    termTotals = np.asarray(annotations.sum(axis=0)).ravel().astype(np.float64)
+    values = np.zeros(len(termNames), dtype=np.float32)
+    defined = (termTotals > 0) & (parentTotals > 0)
+    values[defined] = np.log2(parentTotals[defined] / termTotals[defined])
+    print "Calculated information content for", len(termNames), "terms from", len(annotationTerms), "annotations of", numProteins, "proteins"
+    return InformationContent(termNames, values)
+
+def saveIC(outPath, ic):
+    print "Saving information content to", outPath
+    tempPath = outPath + ".tmp"
+    with open(tempPath, "wb") as f:
+        np.savez(f, term_names=np.array(ic.termNames, dtype=np.string_), values=ic.values)
+    os.rename(tempPath, outPath)
+
+def loadIC(inPath):
+    print "Loading information content from", inPath
+    cache = np.load(inPath)
+    ic = InformationContent(cache["term_names"].tolist(), cache["values"])
+    cache.close()
+    return ic
+
+def getIC(annotationPath, termPairPath, annotationFormat="GO", cacheDir=None):
+    """
+    Get the information content of the ontology terms. If cacheDir is defined, the result is 
+    cached there with a key from the paths, modification times and sizes of the input files, 
+    and recalculated only when the inputs change. Without cacheDir it is always calculated.
+    """
+    cachePath = None
+    if cacheDir != None:
+        key = hashlib.sha1(str(IC_CACHE_VERSION))
+        for inPath in (annotationPath, termPairPath):
+            stat = os.stat(inPath)
+            key.update(repr((os.path.abspath(inPath), stat.st_mtime, stat.st_size)))
+        cachePath = os.path.join(cacheDir, "ic-" + key.hexdigest() + ".npz")
+        if os.path.exists(cachePath):
+            return loadIC(cachePath)
+    annotationRows, annotationTerms = loadAnnotationPairs(annotationPath, annotationFormat)
+    ic = calculateIC(annotationRows, annotationTerms, loadTermPairs(termPairPath))
+    if cachePath == None:
+        return ic
+    try:
+        saveIC(cachePath, ic)
+    except (IOError, OSError) as e:
+        print "Could not cache the information content:", e
+    return ic
+
+class OntologyIndex:
+    """
+    The terms of an ontology DAG in topological order (every parent before its children) with
+    CSR matrices of the direct parents and of all the ancestors of each term. The matrices are
+    indexed by the position of the term in termNames.
+    """
+    def __init__(self, termPairs):
+        names = sorted(set([x for pair in termPairs for x in pair]))
+        nameIndex = dict((names[i], i) for i in xrange(len(names)))
+        parents = np.array([nameIndex[x[0]] for x in termPairs], dtype=np.int64)
+        children = np.array([nameIndex[x[1]] for x in termPairs], dtype=np.int64)
+        levels = self._getLevels(len(names), parents, children)
+        order = np.lexsort((np.arange(len(names)), levels))
+        position = np.empty(len(names), dtype=np.int64)
+        position[order] = np.arange(len(names))
+        self.termNames = [names[i] for i in order]
+        self.index = dict((self.termNames[i], i) for i in xrange(len(self.termNames)))
+        self.levels = levels[order]
+        self.parents = scipy.sparse.csr_matrix((np.ones(len(parents), dtype=np.int8), (position[children], position[parents])), shape=(len(names), len(names)))
+        self.parents.data[:] = 1
+        self.ancestors = self._getAncestors()
+        print "Indexed", len(self.termNames), "ontology terms with", self.parents.nnz, "parent and", self.ancestors.nnz, "ancestor links"
+    
+    def __len__(self):
+        return len(self.termNames)
+    
+    def _getLevels(self, numTerms, parents, children):
+        """
+        The length of the longest path from a root term to each term. Raises an exception if
+        the DAG contains a cycle.
+        """
+        childMatrix = scipy.sparse.csr_matrix((np.ones(len(parents), dtype=np.int8), (parents, children)), shape=(numTerms, numTerms))
+        childMatrix.data[:] = 1
+        remaining = np.asarray(childMatrix.sum(axis=0)).ravel().astype(np.int64)
+        levels = np.zeros(numTerms, dtype=np.int64)
+        frontier = np.flatnonzero(remaining == 0)
+        level = 0
+        numVisited = 0
+        while len(frontier) > 0:
+            levels[frontier] = level
+            numVisited += len(frontier)
+            reached = childMatrix[frontier].indices
+            remaining -= np.bincount(reached, minlength=numTerms)
+            frontier = np.unique(reached[remaining[reached] == 0])
+            level += 1
+        if numVisited != numTerms:
+            raise Exception("The ontology contains a cycle, " + str(numTerms - numVisited) + " terms could not be ordered")
+        return levels
+    
+    def _getAncestors(self):
+        """
+        The transitive closure of the parent matrix, built one level at a time. The terms of
+        a level only have parents on the earlier levels, i.e. at the earlier positions.
+        """
+        numTerms = len(self.termNames)
+        ancestors = scipy.sparse.csr_matrix((0, numTerms), dtype=np.int8)
+        bounds = np.flatnonzero(np.diff(np.concatenate(([-1], self.levels, [-2])))) # The first position of each level
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            if start == 0:
+                block = scipy.sparse.csr_matrix((end - start, numTerms), dtype=np.int8)
+            else:
+                parents = self.parents[start:end, :start]
+                reach = ancestors + scipy.sparse.eye(start, numTerms, dtype=np.int8, format="csr")
+                block = parents.astype(np.int32).dot(reach.astype(np.int32)).tocsr()
+                block.data[:] = 1
+                block = block.astype(np.int8)
+            ancestors = scipy.sparse.vstack([ancestors, block], format="csr")
+        return ancestors
+    
+    def getColumnAncestors(self, columnTerms):
+        """
+        A CSR matrix where the row of each column term has the columns of its ancestors among
+        the column terms. Terms which are not in the ontology have no ancestors.
+        """
+        positions = np.array([self.index.get(x, -1) for x in columnTerms], dtype=np.int64)
+        known = np.flatnonzero(positions >= 0)
+        columnOf = np.full(len(self.termNames), -1, dtype=np.int64)
+        columnOf[positions[known]] = known
+        coo = self.ancestors[positions[known]].tocoo()
+        ancestorCols = columnOf[coo.col]
+        keep = ancestorCols >= 0
+        matrix = scipy.sparse.csr_matrix((np.ones(keep.sum(), dtype=np.int8), (known[coo.row[keep]], ancestorCols[keep])), shape=(len(columnTerms), len(columnTerms)))
+        matrix.sort_indices()
+        return matrix
+    
+    def propagateMax(self, matrix, columnTerms):
+        """
+        Propagate the predictions or confidences of a proteins x terms matrix to the ancestor 
+        terms, so that every ancestor column has at least the maximum value of its descendant
+        columns. The columns of the matrix are the columnTerms, and the matrix can be dense or
+        sparse. Returns a new matrix of the same type.
+        """
+        columnAncestors = self.getColumnAncestors(columnTerms)
+        # The (descendant, ancestor) column pairs sorted by the ancestor
+        descendants = np.repeat(np.arange(len(columnTerms)), np.diff(columnAncestors.indptr))
+        order = np.argsort(columnAncestors.indices, kind="mergesort")
+        descendants, targets = descendants[order], columnAncestors.indices[order]
+        if scipy.sparse.issparse(matrix):
+            coo = scipy.sparse.coo_matrix(matrix)
+            coo.sum_duplicates()
+            starts = columnAncestors.indptr[coo.col]
+            counts = columnAncestors.indptr[coo.col + 1] - starts
+            offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+            rows = np.concatenate((coo.row, np.repeat(coo.row, counts))).astype(np.int64)
+            cols = np.concatenate((coo.col, columnAncestors.indices[offsets]))
+            values = np.concatenate((coo.data, np.repeat(coo.data, counts)))
+            # Keep the maximum value for each cell
+            keys = rows * matrix.shape[1] + cols
+            order = np.argsort(keys)
+            keys, values = keys[order], values[order]
+            first = np.flatnonzero(np.concatenate(([len(keys) > 0], keys[1:] != keys[:-1])))
+            if len(first) > 0:
+                values = np.maximum.reduceat(values, first)
+            keys = keys[first]
+            return scipy.sparse.csr_matrix((values, (keys // matrix.shape[1], keys % matrix.shape[1])), shape=matrix.shape, dtype=matrix.dtype)
+        propagated = np.array(matrix, copy=True)
+        if len(targets) > 0:
+            starts = np.flatnonzero(np.concatenate(([True], targets[1:] != targets[:-1])))
+            uniqueTargets = targets[starts]
+            chunkSize = max(1, 10000000 // len(descendants))
+            for start in xrange(0, propagated.shape[0], chunkSize):
+                block = propagated[start:start + chunkSize]
+                maxima = np.maximum.reduceat(block[:, descendants], starts, axis=1)
+                block[:, uniqueTargets] = np.maximum(block[:, uniqueTargets], maxima)
+        return propagated
+
+def propagateProteins(proteins, predKey, index, limitTerms=None, limitToSets=None):
+    """
+    Propagate the predictions (predKey) of the proteins and their confidences (predKey + 
+    "_conf") to the ancestor terms. Only the limitTerms are used as prediction terms if defined.
+    """
+    confKey = predKey + "_conf"
+    protIds = [x for x in sorted(proteins.keys()) if predKey in proteins[x]]
+    if limitToSets != None:
+        protIds = [x for x in protIds if any(y in limitToSets for y in proteins[x]["sets"])]
+    columnTerms = sorted(limitTerms) if limitTerms else index.termNames
+    columnIndex = dict((columnTerms[i], i) for i in xrange(len(columnTerms)))
+    rows, cols, values = [], [], []
+    for i in xrange(len(protIds)):
+        protein = proteins[protIds[i]]
+        confs = protein.get(confKey, {})
+        for label in protein[predKey]:
+            if label in columnIndex:
+                rows.append(i)
+                cols.append(columnIndex[label])
+                values.append(confs.get(label, 0.01)) # The same default as in evaluation.saveProteins
+    matrix = scipy.sparse.csr_matrix((np.array(values, dtype=np.float64), (rows, cols)), shape=(len(protIds), len(columnTerms)))
+    propagated = index.propagateMax(matrix, columnTerms).tocoo()
+    numAdded = 0
+    for row, col, value in zip(propagated.row, propagated.col, propagated.data):
+        protein = proteins[protIds[row]]
+        label = columnTerms[col]
+        if label not in protein[predKey]:
+            protein[predKey][label] = 1
+            numAdded += 1
+        if confKey not in protein:
+            protein[confKey] = {}
+        if value > protein[confKey].get(label, 0):
+            protein[confKey][label] = value
+    print "Propagated the predictions of", len(protIds), "proteins to the ancestor terms, added", numAdded, "predictions"
@@ -63,7 +63,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Predict GO terms for protein sequences.')
     parser.add_argument('model', help='Path to model directory')
     parser.add_argument('sequences', help='Path to sequence file')
-    parser.add_argument('features', help='Path to feature json file')
+    parser.add_argument('features', help='Path to feature file (examples.json.gz or examples.npz)')
     parser.add_argument('output', help='Path for output file (should be .tsv.gz)')
     
     args = parser.parse_args()
@@ -245,7 +245,7 @@ from task.tasks import Task
 
 def run(dataPath, outDir=None, actions=None, featureGroups=None, classifier=None, classifierArgs=None, 
         limit=None, numTerms=None, useTestSet=False, clear=False, cafaTargets="skip", fold=None, 
-        negatives=False, singleLabelJobs=None, taskName="cafa3", modelPath=None, debug=False):
+        negatives=False, singleLabelJobs=None, taskName="cafa3", modelPath=None, buildJobs=None, fileJobs=None, sortedInput=False, featureCache=None, gridJobs=None, blastTopK=None, blastMaxEvalue=None, blastAggregate=None, debug=False):
     # Initialize the output directory and logging
     if clear and os.path.exists(outDir):
         print "Removing output directory", outDir
@@ -259,6 +259,9 @@ def run(dataPath, outDir=None, actions=None, featureGroups=None, classifier=None
     task = Task.getTask(taskName)
     task.setDataPath(dataPath)
     task.setDebug(debug)
+    task.setFileJobs(fileJobs)
+    task.setSortedInput(sortedInput)
+    task.setBlastPruning(blastTopK, blastMaxEvalue, blastAggregate)
     if numTerms != None:
         task.numTerms = numTerms
     print "Task:", taskName
@@ -272,12 +275,14 @@ def run(dataPath, outDir=None, actions=None, featureGroups=None, classifier=None
     assert not("train" in actions and "classify" in actions)
     
     # Run the requested actions
-    exampleFilePath = os.path.join(outDir, "examples.json.gz")
+    exampleFilePath = os.path.join(outDir, "examples.npz")
+    if "build" not in actions and not os.path.exists(exampleFilePath) and os.path.exists(os.path.join(outDir, "examples.json.gz")):
+        exampleFilePath = os.path.join(outDir, "examples.json.gz") # Examples built with an older version
     task.loadProteins(cafaTargets)
     task.loadSplit(fold)
     if "build" in actions:
         print "==========", "Building Examples", "=========="
-        task.buildExamples(featureGroups, limit)
+        task.buildExamples(featureGroups, limit, buildJobs=buildJobs, cacheDir=featureCache)
         task.saveExamples(exampleFilePath)
     else:
         print "==========", "Loading Examples", "=========="
@@ -285,7 +290,7 @@ def run(dataPath, outDir=None, actions=None, featureGroups=None, classifier=None
     if "train" in actions:
         print "==========", "Training Classifier", "=========="
         task.vectorizeExamples()
-        task.train(outDir, classifier, classifierArgs, singleLabelJobs, negatives, useTestSet)
+        task.train(outDir, classifier, classifierArgs, singleLabelJobs, negatives, useTestSet, gridJobs)
     if "classify" in actions:
         print "==========", "Classifying Examples", "=========="
         if modelPath == None:
@@ -312,10 +317,18 @@ if __name__=="__main__":
     optparser.add_option("-t", "--terms", default=None, type=int, help="Override the task limit for the number of top most common GO terms to use as labels")
     optparser.add_option("-o", "--output", default=None, help="The output directory")
     optparser.add_option('-c','--classifier', help='', default="ensemble.RandomForestClassifier")
-    optparser.add_option('-m','--modelPath', default=None, help="A directory with pickled model files and feature ids. Only used with the 'classify' action.")
+    optparser.add_option('-m','--modelPath', default=None, help="A directory with saved model files and feature ids. Only used with the 'classify' action.")
     optparser.add_option('-r','--args', help='', default="{'random_state':[1], 'n_estimators':[10], 'n_jobs':[1], 'verbose':[3]}")
     #optparser.add_option("--multioutputclassifier", default=False, action="store_true", help="Use the MultiOutputClassifier to train a separate classifier for each label")
-    optparser.add_option("--singleLabelJobs", default=None, type=int, help="Number of jobs for SingleLabelClassification")
+    optparser.add_option("--singleLabelJobs", default=None, type=int, help="Number of processes for learning the labels in SingleLabelClassification")
+    optparser.add_option("--gridJobs", default=None, type=int, help="Number of processes for evaluating the classifier parameter grid in parallel")
+    optparser.add_option("--buildJobs", default=None, type=int, help="Number of processes for building the feature groups in parallel")
+    optparser.add_option("--fileJobs", default=None, type=int, help="Number of processes for reading the files of a feature group in parallel")
+    optparser.add_option("--sortedInput", default=False, action="store_true", help="The feature files are sorted by protein id (use a sorted-merge join)")
+    optparser.add_option("--blastTopK", default=None, type=int, help="Keep only the K hits with the highest bit score for each protein in the BLAST feature groups (overrides the task setting)")
+    optparser.add_option("--blastMaxEvalue", default=None, type=float, help="Skip the BLAST HSPs with a higher e-value (overrides the task setting)")
+    optparser.add_option("--blastAggregate", default=None, help="The value of a BLAST hit with multiple HSPs, one of 'last', 'max' or 'mean' (overrides the task setting)")
+    optparser.add_option("--featureCache", default=None, help="A directory for caching the built feature groups. Only groups whose settings, input files or proteins have changed are rebuilt.")
     optparser.add_option("--testSet", default=False, action="store_true", help="Classify the test set")
     optparser.add_option("--clear", default=False, action="store_true", help="Remove the output directory if it already exists")
     optparser.add_option("--targets", default="skip", help="How to include the CAFA target proteins, one of 'skip', 'overlap' or 'separate'")
@@ -336,4 +349,4 @@ if __name__=="__main__":
         limit=options.limit, numTerms=options.terms, useTestSet=options.testSet, outDir=options.output,
         clear=options.clear, classifier=options.classifier, classifierArgs=options.args, 
         cafaTargets=options.targets, fold=options.fold, negatives=options.negatives, 
-        singleLabelJobs=options.singleLabelJobs, taskName=options.task, modelPath=options.modelPath, debug=options.debug)
\ No newline at end of file
+        singleLabelJobs=options.singleLabelJobs, taskName=options.task, modelPath=options.modelPath, buildJobs=options.buildJobs, fileJobs=options.fileJobs, sortedInput=options.sortedInput, featureCache=options.featureCache, gridJobs=options.gridJobs, blastTopK=options.blastTopK, blastMaxEvalue=options.blastMaxEvalue, blastAggregate=options.blastAggregate, debug=options.debug)
\ No newline at end of file
@@ -2,11 +2,37 @@ import sys, os
 import gzip
 import learning.loading as loading
 import learning.makeFolds as makeFolds
+import learning.ontology as ontology
 import operator
 from collections import Counter
 import json
 from learning.classification import Classification, SingleLabelClassification
 import utils.statistics as statistics
+import itertools
+import numpy as np
+from multiprocessing import Pool
+from cStringIO import StringIO
+
+def _buildFeatureGroup(params):
+    """
+    Build a single feature group, e.g. in a worker process. The proteins are given as (id, sets) 
+    pairs. Returns the feature matrix of the group, the indices of the covered proteins and the 
+    output printed while building it (if captured).
+    """
+    builder, proteinKeys, captureOutput = params
+    stdout = sys.stdout
+    if captureOutput:
+        sys.stdout = StringIO()
+    try:
+        vectorizer = loading.StreamVectorizer()
+        protObjs = [{"id":protId, "sets":sets, "features":vectorizer.addRow()} for protId, sets in proteinKeys]
+        builder.build(protObjs)
+        covered = np.array([i for i in range(len(protObjs)) if protObjs[i]["id"] in builder.covered], dtype=np.int64)
+        protObjs = None
+        matrix, featureNames = vectorizer.getMatrix()
+        return matrix, featureNames, covered, sys.stdout.getvalue() if captureOutput else ""
+    finally:
+        sys.stdout = stdout
 
 class Task(object):
     ###########################################################################
@@ -31,6 +57,8 @@ class Task(object):
     def __init__(self):
         # Internal data structures
         self.proteins = None
+        self.sequences = None
+        self.proteinIndex = None
         self.examples = None
         self.debug = False
         self.modelSaving = False
@@ -44,8 +72,10 @@ class Task(object):
         self.annotationsPath = None # Ontology term annotations for the sequences
         self.splitPath = None # The directory containing the train/devel/test split
         self.foldsPath = None # A file containing the n-fold cross-validation groups
+        self.termPairsPath = None # The parent/child term pairs of the ontology DAG
         # Feature Groups
         self.features = None # A dictionary of feature group name / FeatureBuilder pairs
+        self.blastPruning = None # The topK, maxEvalue and aggregate settings of the BLAST feature groups
         self.defaultFeatures = None # The list of the names of the feature groups which are used by default
         # Task Configuration
         self.numTerms = 5000 # The cutoff for the n most common terms
@@ -65,6 +95,28 @@ class Task(object):
         for group in self.features:
             self.features[group].debug = debug
     
+    def setFileJobs(self, fileJobs):
+        for group in self.features:
+            if hasattr(self.features[group], "fileJobs"):
+                self.features[group].fileJobs = fileJobs
+    
+    def setSortedInput(self, sortedInput):
+        for group in self.features:
+            if hasattr(self.features[group], "sortedInput"):
+                self.features[group].sortedInput = sortedInput
+    
+    def setBlastPruning(self, topK=None, maxEvalue=None, aggregate=None):
+        """
+        Override the pruning settings of the BLAST feature groups. Only the defined values are 
+        changed and the others keep the settings of the task.
+        """
+        for group in self.features:
+            builder = self.features[group]
+            if hasattr(builder, "setPruning"):
+                builder.setPruning(topK if topK != None else builder.topK, 
+                                   maxEvalue if maxEvalue != None else builder.maxEvalue, 
+                                   aggregate if aggregate != None else builder.aggregate)
+    
     def setDataPath(self, dataPath):
         assert self.dataPath == None
         self.dataPath = dataPath
@@ -75,6 +127,7 @@ class Task(object):
             self.splitPath = self._getPath(self.splitPath)
             self.foldsPath = self._getPath(self.foldsPath)
             self.termsPath = self._getPath(self.termsPath)
+            self.termPairsPath = self._getPath(self.termPairsPath)
             for group in self.features:
                 self.features[group].setDataPath(dataPath)
     
@@ -84,10 +137,11 @@ class Task(object):
     def loadProteins(self, cafaTargets="skip"):
         assert cafaTargets in ("skip", "overlap", "separate", "external")
         self.cafaTargets = cafaTargets
-        self.proteins = {}
-        loading.loadFASTA(self.sequencesPath, self.proteins, self.sequenceFormat["sequences"] == "cafa")
+        self.proteins = loading.ProteinTable()
+        self.sequences = loading.SequenceStore()
+        loading.loadFASTA(self.sequencesPath, self.proteins, self.sequenceFormat["sequences"] == "cafa", self.sequences)
         if cafaTargets != "skip" and self.targetsPath != None:
-            loading.loadFASTA(self.targetsPath, self.proteins, self.sequenceFormat["targets"] == "cafa")
+            loading.loadFASTA(self.targetsPath, self.proteins, self.sequenceFormat["targets"] == "cafa", self.sequences)
         if self.removeNonHuman:
             loading.removeNonHuman(self.proteins)
         assert self.annotationFormat in ("GO", "HPO")
@@ -100,12 +154,32 @@ class Task(object):
             print "No annotations to load"
             self.termCounts = {}
         print "Unique terms:", len(self.termCounts)
-        self.topTerms = self.getTopTerms(self.termCounts, self.numTerms)
+        self.topTerms = self.proteins.getTopTerms(self.numTerms)
         print "Using", len(self.topTerms), "most common GO terms"
     
     def getTopTerms(self, counts, num=1000):
         return sorted(counts.items(), key=operator.itemgetter(1), reverse=True)[0:num]
     
+    def getIC(self, cacheDir=None):
+        """
+        The information content of the ontology terms, calculated from the annotations and
+        the ontology DAG (see learning.ontology.getIC), or None if the DAG file is not available.
+        """
+        if self.termPairsPath == None or not os.path.exists(self.termPairsPath):
+            print "No ontology term pairs for calculating the information content"
+            return None
+        return ontology.getIC(self.annotationsPath, self.termPairsPath, self.annotationFormat, cacheDir)
+    
+    def getOntology(self):
+        """
+        An index of the ontology DAG (see learning.ontology.OntologyIndex), or None if the DAG 
+        file is not available.
+        """
+        if self.termPairsPath == None or not os.path.exists(self.termPairsPath):
+            print "No ontology term pairs for indexing the ontology"
+            return None
+        return ontology.OntologyIndex(ontology.loadTermPairs(self.termPairsPath))
+    
     def loadSplit(self, fold=None):
         if self.splitPath == None:
             print "No split to load"
@@ -142,7 +216,7 @@ class Task(object):
             groups.remove(group.strip("-"))
         return groups
     
-    def buildExamples(self, groups=None, limit=None, limitTerms="auto", featureGroups=None):
+    def buildExamples(self, groups=None, limit=None, limitTerms="auto", featureGroups=None, buildJobs=None, cacheDir=None):
         print "Building examples"
         self.examples = {"labels":[], "features":[], "ids":[], "cafa_ids":[], "sets":[], "label_names":[], "label_size":{}}
         protIds = sorted(self.proteins.keys())
@@ -153,51 +227,102 @@ class Task(object):
                     protIds.add(protId)
             protIds = sorted(protIds)
         protObjs = [self.proteins[key] for key in protIds]
+        self.proteinIndex = loading.ProteinIndex(protObjs)
         print "Proteins:", len(protObjs)
+        vectorizer = loading.StreamVectorizer()
         for protein in protObjs:
             # Initialize features
-            protein["features"] = {"DUMMY:dummy":1}
-            # Build labels
-            labels = protein["terms"].keys()
-            if limitTerms:
-                if limitTerms == "auto":
-                    limitTerms = set([x[0] for x in self.topTerms])
-                labels = [x for x in labels if x in limitTerms]
-            labels = sorted(labels)
-            #if len(labels) == 0:
-            #    labels = ["no_annotations"]
-            for label in labels:
-                if label not in self.examples["label_size"]:
-                    self.examples["label_size"][label] = 0
-                self.examples["label_size"][label] += 1
-            self.examples["labels"].append(labels)
+            protein["features"] = vectorizer.addRow()
+            protein["features"]["DUMMY:dummy"] = 1
             self.examples["ids"].append(protein["id"])
             self.examples["cafa_ids"].append(protein["cafa_ids"])
-            self.examples["sets"].append(protein["sets"])
+            self.examples["sets"].append(list(protein["sets"]))
+        # Build labels
+        if limitTerms == "auto":
+            limitTerms = set([x[0] for x in self.topTerms])
+        labels, labelNames = self.proteins.getLabels(protIds, limitTerms if limitTerms else None)
+        self.examples["labels"] = labels.toarray()
+        self.examples["label_names"] = labelNames
+        labelSizes = np.asarray(labels.sum(axis=0)).ravel()
+        self.examples["label_size"] = {name:int(size) for name, size in zip(labelNames, labelSizes)}
         # Build features
         groups = self._getFeatureGroups(groups)
         print "Building features, feature groups =", featureGroups
         for group in groups:
             if group not in self.features.keys():
                 raise Exception("Unknown feature group '" + str(group) + "'")
-            print "Building features for group", group
-            self.features[group].build(protObjs)
-        self.examples["features"] = [x["features"] for x in protObjs]
+        if (buildJobs != None and buildJobs > 1) or cacheDir != None:
+            self._buildGroupMatrices(groups, protObjs, vectorizer, buildJobs, cacheDir)
+        else:
+            for group in groups:
+                print "Building features for group", group
+                self.features[group].build(protObjs, self.proteinIndex)
+        self.examples["features"], self.examples["feature_names"] = vectorizer.getMatrix()
         for protObj in protObjs:
             del protObj["features"]
         # Prepare the examples
         print "Built", len(self.examples["labels"]), "examples" # with", len(examples["feature_names"]), "unique features"
         return self.examples
     
+    def _buildGroupMatrices(self, groups, protObjs, vectorizer, buildJobs=None, cacheDir=None):
+        """
+        Build each feature group as a separate feature matrix and add the matrices to the 
+        vectorizer. Groups with an up-to-date cached matrix are loaded from the cache directory, 
+        and the rest are built in parallel if buildJobs is defined.
+        """
+        proteinKeys = [(x["id"], x["sets"]) for x in protObjs]
+        cachePaths = {}
+        if cacheDir != None:
+            if not os.path.exists(cacheDir):
+                os.makedirs(cacheDir)
+            protIds = [x["id"] for x in protObjs]
+            for group in groups:
+                cachePaths[group] = os.path.join(cacheDir, group + "-" + self.features[group].getCacheKey(protIds) + ".npz")
+        cached = [x for x in groups if x in cachePaths and os.path.exists(cachePaths[x])]
+        missing = [x for x in groups if x not in cached]
+        if cacheDir != None:
+            print "Feature cache", cacheDir, "hits =", cached, "misses =", missing
+        pool = None
+        if buildJobs != None and buildJobs > 1 and len(missing) > 0:
+            print "Building", len(missing), "feature groups using", buildJobs, "processes"
+            pool = Pool(min(buildJobs, len(missing)))
+            results = pool.imap(_buildFeatureGroup, [(self.features[group], proteinKeys, True) for group in missing], chunksize=1)
+        else:
+            results = itertools.imap(_buildFeatureGroup, [(self.features[group], proteinKeys, False) for group in missing])
+        try:
+            for group in groups:
+                print "Building features for group", group
+                if group in cached:
+                    matrix, featureNames, covered = loading.loadFeatureCache(cachePaths[group])
+                    builder = self.features[group]
+                    builder.beginCoverage(protObjs)
+                    for index in covered:
+                        builder.addToCoverage(protObjs[index])
+                    builder.finishCoverage()
+                else:
+                    matrix, featureNames, covered, output = results.next()
+                    sys.stdout.write(output)
+                    if group in cachePaths:
+                        loading.saveFeatureCache(cachePaths[group], matrix, featureNames, covered)
+                vectorizer.addMatrix(matrix, featureNames)
+        finally:
+            if pool != None:
+                pool.terminate()
+        if cacheDir != None:
+            print "Feature cache summary, hits:", len(cached), "misses:", len(missing)
+    
     def saveExamples(self, exampleFilePath):
         print "Saving examples to", exampleFilePath
-        with gzip.open(exampleFilePath, "wt") as pickleFile:
-            json.dump(self.examples, pickleFile, indent=2, sort_keys=True)
+        self.vectorizeExamples()
+        loading.saveExampleStore(self.examples, exampleFilePath)
     
     def loadExamples(self, exampleFilePath):
         print "Loading examples from", exampleFilePath
-        with gzip.open(exampleFilePath, "rt") as pickleFile:
-            self.examples = json.load(pickleFile)
+        if exampleFilePath.endswith(".json.gz"):
+            with gzip.open(exampleFilePath, "rt") as pickleFile:
+                self.examples = json.load(pickleFile)
+        else:
+            self.examples = loading.loadExampleStore(exampleFilePath)
     
     ###########################################################################
     # Classification
@@ -206,14 +331,16 @@ class Task(object):
     def vectorizeExamples(self, idPath=None):
         loading.vectorizeExamples(self.examples, idPath=idPath)
     
-    def train(self, outDir, classifier=None, classifierArgs=None, singleLabelJobs=None, negatives=False, useTestSet=False):
+    def train(self, outDir, classifier=None, classifierArgs=None, singleLabelJobs=None, negatives=False, useTestSet=False, gridJobs=None):
         terms = loading.loadGOTerms(self.termsPath)
         loading.saveIdNames(self.examples["feature_names"], os.path.join(outDir, "features.tsv.gz"))
         loading.saveIdNames(self.examples["label_names"], os.path.join(outDir, "labels.tsv"))
         if singleLabelJobs == None:
-            cls = Classification()
+            cls = Classification(gridJobs)
         else:
             cls = SingleLabelClassification(singleLabelJobs)
+        if self.cafaTargets != "skip":
+            cls.ontology = self.getOntology()
         cls.optimize(classifier, classifierArgs, self.examples, terms=terms, 
                      outDir=outDir, negatives=negatives,
                      useTestSet=useTestSet, useCAFASet=(self.cafaTargets != "skip"))
@@ -226,6 +353,8 @@ class Task(object):
             cls = Classification()
         else:
             cls = SingleLabelClassification(singleLabelJobs)
+        if self.cafaTargets != "skip":
+            cls.ontology = self.getOntology()
         cls.predict(modelPath, self.examples, terms=terms, outDir=outDir, negatives=negatives, useTestSet=useTestSet, useCAFASet=(self.cafaTargets != "skip"))
     
     def makeStatistics(self, outDir):
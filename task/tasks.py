@@ -14,13 +14,15 @@ class CAFA3Task(Task):
         self.splitPath = "data"
         self.foldsPath = "folds/training_folds_170125.tsv.gz"
         self.termsPath = "GO/go_terms.tsv"
+        self.termPairsPath = "data/parent_term2term.txt.gz"
         # Feature settings
+        self.blastPruning = {"topK":None, "maxEvalue":None, "aggregate":"last"} # The BLAST hit pruning of the task (see BlastFeatureBuilder)
         self.features = {
             "taxonomy":TaxonomyFeatureBuilder(["Taxonomy"]),
             "similar":UniprotFeatureBuilder("Uniprot/similar.txt"),
-            "blast":BlastFeatureBuilder(["temp_blastp_result_features", "blastp_result_features"]),
-            "blast62":BlastFeatureBuilder(["CAFA2/training_features", "CAFA2/CAFA3_features"], tag="BLAST62"),
-            "delta":BlastFeatureBuilder(["temp_deltablast_result_features", "deltablast_result_features"], tag="DELTA"),
+            "blast":BlastFeatureBuilder(["temp_blastp_result_features", "blastp_result_features"], **self.blastPruning),
+            "blast62":BlastFeatureBuilder(["CAFA2/training_features", "CAFA2/CAFA3_features"], tag="BLAST62", **self.blastPruning),
+            "delta":BlastFeatureBuilder(["temp_deltablast_result_features", "deltablast_result_features"], tag="DELTA", **self.blastPruning),
             "interpro":InterProScanFeatureBuilder(["temp_interproscan_result_features", "interproscan_result_features"]),
             "predgpi":PredGPIFeatureBuilder(["predGPI"]),
             "nucpred":NucPredFeatureBuilder(["nucPred"]),
@@ -39,6 +41,7 @@ class CAFA3HPOTask(CAFA3Task):
         self.annotationFormat = "HPO"
         self.annotationsPath = "HPO/annotation/all_cafa_annotation_propagated.tsv.gz"
         self.termsPath = "HPO/ontology/hp.obo"
+        self.termPairsPath = "HPO/ontology/hp.obo"
         
 class CAFAQATask(CAFA3Task):
     def __init__(self):
@@ -49,8 +52,8 @@ class CAFAQATask(CAFA3Task):
         self.remapSets = {"undefined":"cafa"}
         self.features.update({
             "taxonomy":TaxonomyFeatureBuilder(["Taxonomy"] + ["../../CAFA_QA/features/Taxonomy"], debug=True),
-            "blast":BlastFeatureBuilder(["temp_blastp_result_features", "blastp_result_features"] + ["../../CAFA_QA/features/blast_result_features"]),
-            "delta":BlastFeatureBuilder(["temp_deltablast_result_features", "deltablast_result_features"] + ["../../CAFA_QA/features/deltablast_result_features"], tag="DELTA"),
+            "blast":BlastFeatureBuilder(["temp_blastp_result_features", "blastp_result_features"] + ["../../CAFA_QA/features/blast_result_features"], **self.blastPruning),
+            "delta":BlastFeatureBuilder(["temp_deltablast_result_features", "deltablast_result_features"] + ["../../CAFA_QA/features/deltablast_result_features"], tag="DELTA", **self.blastPruning),
             "interpro":InterProScanFeatureBuilder(["temp_interproscan_result_features", "interproscan_result_features"] + ["../../CAFA_QA/features/interproscan_result_features"]),
             "predgpi":PredGPIFeatureBuilder(["predGPI"] + ["../../CAFA_QA/features/predGPI"])
         })
@@ -86,12 +89,14 @@ class CAFAPITask(Task):
         self.splitPath = "CAFA_PI/Swissprot"
         self.foldsPath = "folds/CAFA_PI_training_folds_180417.tsv.gz"
         self.termsPath = "GO/go_terms.tsv"
+        self.termPairsPath = "data/parent_term2term.txt.gz"
         # Feature settings
+        self.blastPruning = {"topK":None, "maxEvalue":None, "aggregate":"last"} # The BLAST hit pruning of the task (see BlastFeatureBuilder)
         self.features = {
             "taxonomy":TaxonomyFeatureBuilder(["CAFA_PI/features/Taxonomy"]),
-            "blast":BlastFeatureBuilder(["CAFA_PI/features/temp_blastp_result_features", "CAFA_PI/features/blastp_result_features"]),
-            "blast62":BlastFeatureBuilder(["CAFA_PI/features/CAFA2/training_features", "CAFA_PI/features/CAFA2/CAFA3_features"], tag="BLAST62"),
-            "delta":BlastFeatureBuilder(["CAFA_PI/features/temp_deltablast_result_features", "CAFA_PI/features/deltablast_result_features"], tag="DELTA"),
+            "blast":BlastFeatureBuilder(["CAFA_PI/features/temp_blastp_result_features", "CAFA_PI/features/blastp_result_features"], **self.blastPruning),
+            "blast62":BlastFeatureBuilder(["CAFA_PI/features/CAFA2/training_features", "CAFA_PI/features/CAFA2/CAFA3_features"], tag="BLAST62", **self.blastPruning),
+            "delta":BlastFeatureBuilder(["CAFA_PI/features/temp_deltablast_result_features", "CAFA_PI/features/deltablast_result_features"], tag="DELTA", **self.blastPruning),
             "interpro":InterProScanFeatureBuilder(["CAFA_PI/features/temp_interproscan_result_features", "CAFA_PI/features/interproscan_result_features"]),
             "predgpi":PredGPIFeatureBuilder(["CAFA_PI/features/predGPI"]),
             "nucpred":NucPredFeatureBuilder(["CAFA_PI/features/nucPred"]),
@@ -179,8 +179,42 @@ def generate_data(split_path, seq_path, ann_path, ann_ids, batches=125, cafa_tar
 # 
 # aa_index_ids, aa_embedding = read_aaindex()
 
+def read_feature_store(path, vectorizer=None, filters=('DUMMY',)):
+    """
+    Reads the binary examples.npz store written by run.py. Returns the same
+    protein ids, feature matrix and vectorizer as the JSON path, without
+    re-vectorizing the feature dictionaries.
+    """
+    import scipy.sparse
+    from sklearn.feature_extraction import DictVectorizer
+    store = np.load(path)
+    ids = [x.decode('utf-8') for x in store['ids'].tolist()]
+    names = [x.decode('utf-8') for x in store['feature_names'].tolist()]
+    matrix = scipy.sparse.csr_matrix((store['feature_data'], store['feature_indices'], store['feature_indptr']), shape=tuple(store['feature_shape']))
+    print("Excluding: ", filters)
+    if vectorizer:
+        v = vectorizer
+    else:
+        v = DictVectorizer()
+        # Only get features that exist in training examples to densify the feature space, all the rest are useless anyway
+        train_ids = set(read_split_ids('./data/train.txt.gz', unique=False))
+        train_rows = [i for i, prot_id in enumerate(ids) if prot_id in train_ids]
+        in_train = np.zeros(len(names), dtype=bool)
+        in_train[matrix[train_rows].indices] = True
+        v.feature_names_ = sorted(names[i] for i in np.nonzero(in_train)[0] if not any(names[i].startswith('%s:' % f) for f in filters))
+        v.vocabulary_ = {f: i for i, f in enumerate(v.feature_names_)}
+    # Move the stored columns to the vectorizer's columns, dropping the unknown ones
+    mapping = np.array([v.vocabulary_.get(name, -1) for name in names], dtype=np.int64)
+    coo = matrix.tocoo()
+    keep = mapping[coo.col] >= 0
+    feature_matrix = scipy.sparse.csr_matrix((coo.data[keep], (coo.row[keep], mapping[coo.col[keep]])), shape=(matrix.shape[0], len(v.vocabulary_)))
+    return ids, feature_matrix, v
+
 def read_feature_json(path='./data/examples.json.gz', vectorizer=None, feature_selector=None):
     print('Reading feature data')
+    if path.endswith('.npz'):
+        ids, feature_matrix, v = read_feature_store(path, vectorizer)
+        return _select_features(feature_matrix, ids, v, feature_selector)
     js = json.load(gzip.open(path, 'rt'))
     # import pdb; pdb.set_trace()
     filters = ['DUMMY']#['BLAST', 'DELTA', 'GPI', 'TAX', 'IPS']
@@ -211,7 +245,10 @@ def read_feature_json(path='./data/examples.json.gz', vectorizer=None, feature_s
 
     feature_matrix = v.transform(js['features'])
     
-    id_map = {pid: i for i, pid in enumerate(js['ids'])}
+    return _select_features(feature_matrix, js['ids'], v, feature_selector)
+
+def _select_features(feature_matrix, ids, v, feature_selector=None):
+    id_map = {pid: i for i, pid in enumerate(ids)}
     
     from sklearn import preprocessing
     scaler = preprocessing.MaxAbsScaler().fit(feature_matrix)
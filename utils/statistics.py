@@ -11,9 +11,9 @@ if os.environ.get('DISPLAY','') == '':
 import matplotlib.pyplot as plt
 
 def getCategories(sets):
-    categories = sets
+    categories = list(sets)
     if len(sets) == 1:
-        categories += [sets[0] + " only"]
+        categories.append(sets[0] + " only")
     return categories
 
 def getCounts(examples):